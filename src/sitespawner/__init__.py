@@ -4,12 +4,15 @@
 
 import argparse
 import logging
+import os
 from importlib.metadata import PackageNotFoundError, version
 from pathlib import Path
 
 from sitespawner.common import get_logger, root_dir, set_loglevel
+from sitespawner.compress import DEFAULT_COMPRESS_MIN_SIZE
 from sitespawner.convert_data import convert_data
 from sitespawner.gen_coverage_report import main as gen
+from sitespawner.tracefile import DEFAULT_CACHE_SIZE, DEFAULT_MERGE_FAN_IN
 from sitespawner.update_webpage import update_webpage
 
 try:
@@ -67,6 +70,14 @@ def webpage_handler(args):
         args.doc_project_name,
         args.include_documentation,
         args.page_url,
+        compress=args.compress,
+        compress_min_size=args.compress_min_size,
+        jobs=args.jobs,
+        cache_dir=args.cache_dir,
+        sphinx_subprocess=args.sphinx_subprocess,
+        retain_last=args.retain_last,
+        retain_days=args.retain_days,
+        retention_dry_run=args.retention_dry_run,
     )
 
 
@@ -130,9 +141,81 @@ def setup_parser():
             ),
         },
     }
+    jobs = {
+        "name": "--jobs",
+        "options": {
+            "metavar": "jobs",
+            "type": int,
+            "default": os.cpu_count(),
+            "help": "Number of parallel workers. Defaults to the number of CPUs.",
+        },
+    }
+
+    incremental = {
+        "name": "--incremental",
+        "options": {
+            "action": "store_true",
+            "dest": "incremental",
+            "help": (
+                "Only convert *.dat files which changed since the previous run "
+                "and remove *.info files whose *.dat files no longer exist."
+            ),
+        },
+    }
+
+    converter = {
+        "name": "--converter",
+        "options": {
+            "metavar": "converter",
+            "choices": ["native", "verilator"],
+            "default": "native",
+            "help": (
+                "Tool used for *.dat -> *.info conversion: the built-in reader (native) "
+                "or Verilator's verilator_coverage (verilator)."
+            ),
+        },
+    }
+
+    merge = {
+        "name": "--merge",
+        "options": {
+            "metavar": "merge_name",
+            "nargs": "?",
+            "const": "merged",
+            "default": None,
+            "type": str,
+            "help": (
+                "Merge all *.dat files of the same coverage type (e.g. *_branch.dat) "
+                "into a single coverage_<merge_name>_<type>.info file, and the remaining ones "
+                "into coverage_<merge_name>.info. "
+                "Defaults to 'merged' if no name is given."
+            ),
+        },
+    }
+
+    compress = {
+        "name": "--compress",
+        "options": {
+            "action": "store_true",
+            "dest": "compress",
+            "help": (
+                "Write pre-compressed .gz (and .br if brotli is installed) copies "
+                "of generated HTML/CSS/JS files, e.g. for nginx's gzip_static."
+            ),
+        },
+    }
+    compress_min_size = {
+        "name": "--compress-min-size",
+        "options": {
+            "metavar": "compress_min_size",
+            "type": int,
+            "default": DEFAULT_COMPRESS_MIN_SIZE,
+            "help": "Files smaller than that many bytes are not compressed.",
+        },
+    }
 
     subparsers = parser.add_subparsers(dest="cmd")
-    convert_args = [dat_dir, info_dir]
+    convert_args = [dat_dir, info_dir, jobs, incremental, converter, merge]
     create_subparser(
         subparsers=subparsers,
         name="convert",
@@ -147,8 +230,11 @@ def setup_parser():
         "options": {
             "metavar": "logo_src",
             "type": str,
-            "default": "_static/white.svg",
-            "help": "Path to logo to be attached with the report, relative to index.html file in the destination dir.",  # noqa: E501
+            "default": None,
+            "help": (
+                "Path to logo to be attached with the report, relative to index.html file "
+                "in the destination dir. If not specified, the bundled logo is used."
+            ),
         },
     }
     logo_href = {
@@ -231,6 +317,64 @@ def setup_parser():
             "help": ("Pattern for *.info files to look for."),
         },
     }
+    merge_fan_in = {
+        "name": "--merge-fan-in",
+        "options": {
+            "metavar": "merge_fan_in",
+            "type": int,
+            "default": DEFAULT_MERGE_FAN_IN,
+            "help": (
+                "Maximum number of *.info files merged at once. "
+                "Larger sets are merged through intermediate files on disk."
+            ),
+        },
+    }
+    cache_dir = {
+        "name": "--cache-dir",
+        "options": {
+            "metavar": "cache_dir",
+            "type": str,
+            "default": None,
+            "help": (
+                "Directory for caches persisted between runs "
+                "(e.g. parsed *.info files, compiled templates, Sphinx environment). "
+                "If not specified, nothing is cached on disk."
+            ),
+        },
+    }
+    cache_size = {
+        "name": "--cache-size",
+        "options": {
+            "metavar": "cache_size",
+            "type": int,
+            "default": DEFAULT_CACHE_SIZE,
+            "help": "Size limit of the cache directory in MiB, least recently used entries are evicted.",  # noqa: E501
+        },
+    }
+    reproducible = {
+        "name": "--reproducible",
+        "options": {
+            "action": "store_true",
+            "dest": "reproducible",
+            "help": (
+                "Generate byte-identical dashboards from identical inputs. Pages are stamped with "
+                "SOURCE_DATE_EPOCH or, if it isn't set, the time of the current git commit."
+            ),
+        },
+    }
+    table_mode = {
+        "name": "--table-mode",
+        "options": {
+            "metavar": "table_mode",
+            "choices": ["html", "json"],
+            "default": "html",
+            "help": (
+                "How coverage tables are generated: as static HTML (html) or as JSON data "
+                "rendered in the browser, with sorting, filtering and virtual scrolling (json). "
+                "The json mode requires the dashboard to be served over HTTP."
+            ),
+        },
+    }
     reports_args = [
         logo_src,
         logo_href,
@@ -241,6 +385,14 @@ def setup_parser():
         src_remove_pattern,
         src_project_name,
         info_pattern,
+        merge_fan_in,
+        jobs,
+        cache_dir,
+        cache_size,
+        reproducible,
+        table_mode,
+        compress,
+        compress_min_size,
     ]
     create_subparser(
         subparsers=subparsers,
@@ -303,6 +455,46 @@ def setup_parser():
             "help": "Whethet to include documentation in the built webpage",
         },
     }
+    sphinx_subprocess = {
+        "name": "--sphinx-subprocess",
+        "options": {
+            "action": "store_true",
+            "dest": "sphinx_subprocess",
+            "help": (
+                "Run Sphinx as a separate `sphinx-build` process instead of within SiteSpawner "
+                "(also done when the SPHINXBUILD environment variable is set)."
+            ),
+        },
+    }
+    retain_last = {
+        "name": "--retain-last",
+        "options": {
+            "metavar": "retain_last",
+            "type": int,
+            "default": None,
+            "help": (
+                "Keep only this many most recently deployed dev/* directories "
+                "(branches and pull requests), including the current one."
+            ),
+        },
+    }
+    retain_days = {
+        "name": "--retain-days",
+        "options": {
+            "metavar": "retain_days",
+            "type": int,
+            "default": None,
+            "help": "Remove dev/* directories which weren't deployed in this many days.",
+        },
+    }
+    retention_dry_run = {
+        "name": "--retention-dry-run",
+        "options": {
+            "action": "store_true",
+            "dest": "retention_dry_run",
+            "help": "Only list dev/* directories which would be removed by the retention policy.",
+        },
+    }
     webpage_args = [
         ref_name,
         event_name,
@@ -310,6 +502,14 @@ def setup_parser():
         page_url,
         doc_project_name,
         include_documentation,
+        jobs,
+        compress,
+        compress_min_size,
+        cache_dir,
+        sphinx_subprocess,
+        retain_last,
+        retain_days,
+        retention_dry_run,
     ]
     create_subparser(
         subparsers=subparsers,
@@ -320,12 +520,18 @@ def setup_parser():
         handler=webpage_handler,
     )
 
+    # Options shared between the steps are added only once
+    all_args = []
+    for arg in convert_args + reports_args + webpage_args:
+        if arg not in all_args:
+            all_args.append(arg)
+
     create_subparser(
         subparsers=subparsers,
         name="all",
         description="Execute all steps consecutively.",
         help_text="Perform data conversion, coverage dashboard generation and assemble the webpage.",  # noqa: E501
-        args_list=convert_args + reports_args + webpage_args,
+        args_list=all_args,
         handler=all_handler,
     )
 
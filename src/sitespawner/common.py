@@ -2,9 +2,14 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import hashlib
 import logging
+import os
 import sys
-from functools import wraps
+import tempfile
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from shutil import copy2, copystat
 from typing import Any
 
 from termcolor import colored
@@ -12,6 +17,11 @@ from termcolor import colored
 import sitespawner.styles
 import sitespawner.template
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 try:
     from importlib import resources
 except ModuleNotFoundError:
@@ -60,6 +70,74 @@ template_dir = flatten_path(template_dir)
 styles_dir = flatten_path(styles_dir)
 
 
+def file_digest(path):
+    """SHA-256 of the file contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(src, dst):
+    """Hardlinks `src` to `dst`, copies it if linking isn't possible (e.g. across filesystems).
+    An existing `dst` is replaced rather than written to, so files linked to it stay intact."""
+    dst = os.fspath(dst)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        copy2(src, dst)
+
+
+# ioctl request cloning a file's data blocks (Linux)
+FICLONE = 0x40049409
+
+
+def reflink_or_copy(src, dst):
+    """Copies `src` to `dst`, sharing its data blocks (reflink) if the filesystem supports it.
+    Unlike a hardlink, the copy can be later modified independently of `src`."""
+    dst = os.fspath(dst)
+    if os.path.lexists(dst):
+        os.unlink(dst)
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            copystat(src, dst)
+            return
+        except OSError:
+            pass
+    copy2(src, dst)
+
+
+@lru_cache(maxsize=None)
+def current_umask():
+    """Process umask, applied to files created through temporary files."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+@contextmanager
+def atomic_write(path, mode="w", buffering=-1):
+    """Opens a temporary file next to `path` which is moved over `path` once the block
+    completes. Readers (and hardlinks) of the previous version never see a partial file."""
+    path = os.fspath(path)
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(path) or ".", prefix=f".{os.path.basename(path)}.", suffix=".tmp"
+    )
+    try:
+        with open(fd, mode, buffering=buffering) as f:
+            yield f
+        os.chmod(tmp_path, 0o666 & ~current_umask())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
 def get_logger(name: str) -> logging.Logger:
     """Returns a logger with the specified name.
 
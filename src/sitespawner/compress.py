@@ -0,0 +1,107 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import gzip
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from sitespawner.common import args_on_debug_logger, atomic_write, get_logger, main_func_log
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+logger = get_logger(__name__)
+
+# Files smaller than that gain too little from compression to be worth it (bytes)
+DEFAULT_COMPRESS_MIN_SIZE = 1024
+COMPRESSIBLE_SUFFIXES = {".html", ".css", ".js", ".json", ".svg"}
+
+
+def gzip_compress(data):
+    # Without a timestamp in the header, identical files compress identically
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def brotli_compress(data):
+    return brotli.compress(data, mode=brotli.MODE_TEXT)
+
+
+COMPRESSORS = {".gz": gzip_compress}
+if brotli is not None:
+    COMPRESSORS[".br"] = brotli_compress
+
+# Suffixes of all compressed siblings, including those of compressors unavailable in this run
+COMPRESSED_SUFFIXES = {".gz", ".br"}
+
+
+def is_compressed_current(path, compressed_path):
+    """Compressed siblings carry the modification time of their source,
+    any other modification time means the source changed since."""
+    try:
+        return compressed_path.stat().st_mtime_ns == path.stat().st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def compress_file(path):
+    """Writes compressed siblings (e.g. index.html.gz) of the file at `path`."""
+    path = Path(path)
+    data = path.read_bytes()
+    st = path.stat()
+    for suffix, compress in COMPRESSORS.items():
+        compressed_path = path.with_name(path.name + suffix)
+        with atomic_write(compressed_path, "wb") as f:
+            f.write(compress(data))
+        os.utime(compressed_path, ns=(st.st_atime_ns, st.st_mtime_ns))
+    return path
+
+
+@main_func_log(logger, "Compress static files")
+@args_on_debug_logger(logger)
+def compress_tree(root, jobs=None, min_size=DEFAULT_COMPRESS_MIN_SIZE):
+    """Writes .gz (and .br if brotli is installed) siblings of HTML/CSS/JS files in `root`
+    at least `min_size` bytes big, e.g. for nginx's `gzip_static`. Only files modified
+    since the previous run are compressed. Siblings of removed files, and ones
+    whose compressor isn't available, are deleted."""
+    root = Path(root)
+    pending = []
+    for path in sorted(root.rglob("*")):
+        source = path.with_suffix("")
+        if path.suffix in COMPRESSED_SUFFIXES and source.suffix in COMPRESSIBLE_SUFFIXES:
+            # Siblings which can't be refreshed would go out of date with their source
+            if (
+                path.suffix not in COMPRESSORS
+                or not source.is_file()
+                or source.stat().st_size < min_size
+            ):
+                logger.debug(f"Removing stale {path}")
+                path.unlink()
+            continue
+
+        # Hidden files (e.g. manifests) aren't served
+        if path.name.startswith(".") or path.suffix not in COMPRESSIBLE_SUFFIXES:
+            continue
+        if not path.is_file():
+            continue
+        if path.stat().st_size < min_size:
+            continue
+        if all(
+            is_compressed_current(path, path.with_name(path.name + suffix))
+            for suffix in COMPRESSORS
+        ):
+            continue
+        pending.append(path)
+
+    if not pending:
+        logger.info(f"All compressed files in {root} are up to date")
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        for path in executor.map(compress_file, pending, chunksize=16):
+            logger.debug(f"Compressed {path}")
+
+    logger.info(f"Compressed {len(pending)} files in {root} ({', '.join(COMPRESSORS)})")
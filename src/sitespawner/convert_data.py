@@ -2,21 +2,320 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import json
+import os
 import subprocess
+import traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
 
-from sitespawner.common import args_on_debug_logger, get_logger, main_func_log
+from sitespawner.common import args_on_debug_logger, file_digest, get_logger, main_func_log
 
 logger = get_logger(__name__)
 
+# Name of the manifest kept next to the produced *.info files in the incremental mode
+MANIFEST_NAME = ".sis_convert_manifest.json"
+
+# Version of the native converter output, bump when the produced *.info files change
+NATIVE_CONVERTER_VERSION = 1
+
+# Separators of keys and values in Verilator's coverage point descriptions
+POINT_KEY_SEP = "\x01"
+POINT_VALUE_SEP = "\x02"
+
+# Same as the default of `verilator_coverage --annotate-min`,
+# branches counted less times than that are not reported as hit in BRH
+ANNOTATE_MIN = 10
+
+# Types of Verilator's coverage points, *.dat files of a single type are named `*_<type>.dat`
+COVERAGE_TYPES = ("branch", "expr", "line", "toggle", "user")
+
+# *.dat files may contain arbitrary bytes in point descriptions, preserve them as they are
+DAT_ENCODING = {"encoding": "utf-8", "errors": "surrogateescape"}
+
+
+def read_dat(dat_file, points=None):
+    """Reads coverage points from a Verilator *.dat file.
+
+    Returns a dict mapping point descriptions to hit counts, in order of appearance.
+    If `points` is given, counts are accumulated into it."""
+    if points is None:
+        points = {}
+
+    with open(dat_file, **DAT_ENCODING) as f:
+        for line in f:
+            if not line.startswith("C '"):
+                continue
+            end = line.find("' ", 3)
+            if end < 0:
+                msg = f"Malformed coverage point in {dat_file}: {line.strip()}"
+                raise ValueError(msg)
+            point = line[3:end]
+            points[point] = points.get(point, 0) + int(line[end + 2 :])
+
+    return points
+
+
+def parse_point(point):
+    """Splits a coverage point description into a dict of keys and values."""
+    fields = {}
+    for item in point.split(POINT_KEY_SEP):
+        key, _, value = item.partition(POINT_VALUE_SEP)
+        if key:
+            fields[key] = value
+    return fields
+
+
+def parse_lines_range(linescov):
+    """Expands a list of line ranges (e.g. `12-14,20`) into line numbers.
+    Line 0 doesn't refer to a source line and is skipped."""
+    for chunk in linescov.split(","):
+        start, _, end = chunk.partition("-")
+        if not start.isdigit():
+            continue
+        end = end if end.isdigit() else start
+        yield from range(max(int(start), 1), int(end) + 1)
+
+
+def annotate_points(points):
+    """Assigns coverage points to source lines following the rules of `verilator_coverage`.
+
+    Returns a dict mapping source files to dicts of line numbers
+    and hit counts of the points covering the given line."""
+    sources = {}
+    for point, count in points.items():
+        fields = parse_point(point)
+        filename = fields.get("f", "")
+        lineno = int(fields.get("l", 0) or 0)
+        if not filename or lineno == 0:
+            continue
+
+        lines = sources.setdefault(filename, {})
+        linenos = [lineno, *parse_lines_range(fields.get("S", ""))]
+        for line in linenos:
+            # Point descriptions are unique, so they identify points on the line
+            lines.setdefault(line, {})[point] = count
+
+    return sources
+
+
+def write_info(points, info_path, annotate_min=ANNOTATE_MIN):
+    """Writes coverage points into an LCOV tracefile with
+    line (DA) and branch (BRDA) records, modelled on `verilator_coverage --write-info`."""
+    sources = annotate_points(points)
+
+    with open(info_path, "w", **DAT_ENCODING) as f:
+        f.write("TN:verilator_coverage\n")
+        for filename in sorted(sources):
+            f.write(f"SF:{filename}\n")
+            branches_found = 0
+            branches_hit = 0
+            lines = sources[filename]
+            for lineno in sorted(lines):
+                counts = list(lines[lineno].values())
+                f.write(f"DA:{lineno},{max(counts)}\n")
+                if len(counts) == 1:
+                    continue
+                branches_found += len(counts)
+                for num, count in enumerate(counts):
+                    f.write(f"BRDA:{lineno},0,{num},{count}\n")
+                    branches_hit += count >= annotate_min
+            f.write(f"BRF:{branches_found}\n")
+            f.write(f"BRH:{branches_hit}\n")
+            f.write("end_of_record\n")
+
+
+def describe_inputs(dat_files):
+    """Short description of conversion inputs for logs."""
+    if len(dat_files) == 1:
+        return str(dat_files[0])
+    return f"{len(dat_files)} *.dat files"
+
+
+def convert_native(dat_files, info_path):
+    """Converts *.dat coverage data files into an *.info file in-process.
+    Hit counts of points present in multiple files are summed."""
+    points = {}
+    for dat_file in dat_files:
+        try:
+            read_dat(dat_file, points)
+        except (OSError, ValueError) as e:
+            msg = f"Failed to convert {dat_file}"
+            raise Exception(msg) from e
+
+    try:
+        write_info(points, info_path)
+    except OSError as e:
+        msg = f"Failed to write {info_path}"
+        raise Exception(msg) from e
+    logger.debug(f"Conversion: {describe_inputs(dat_files)} -> {info_path} SUCCEEDED")
+
+
+def convert_verilator(dat_files, info_path):
+    """Converts *.dat coverage data files into an *.info file with `verilator_coverage`.
+    Hit counts of points present in multiple files are summed."""
+    try:
+        subprocess.run(
+            [
+                "verilator_coverage",
+                "--write-info",
+                info_path,
+                *dat_files,
+            ],
+            check=True,
+        )
+        logger.debug(f"Conversion: {describe_inputs(dat_files)} -> {info_path} SUCCEEDED")
+    except subprocess.CalledProcessError as e:
+        msg = f"Failed to convert {describe_inputs(dat_files)}"
+        raise Exception(msg) from e
+
+
+def innermost_cause(e):
+    """Last exception of the `__cause__` chain of `e`."""
+    while e.__cause__ is not None:
+        e = e.__cause__
+    return e
+
+
+def run_conversion(convert, dat_files, info_path):
+    """Runs `convert` in a worker. Causes of exceptions don't survive the transfer
+    from worker processes, so a failure is reported with its innermost cause in the message."""
+    try:
+        convert(dat_files, info_path)
+    except Exception as e:
+        cause = innermost_cause(e)
+        if cause is e:
+            raise
+        msg = f"{e} ({type(cause).__name__}: {cause})"
+        raise Exception(msg) from e
+
+
+# Available *.dat -> *.info converters. The native one is CPU-bound,
+# so it runs in a process pool while `verilator_coverage` calls run in threads.
+CONVERTERS = {
+    "native": (convert_native, ProcessPoolExecutor),
+    "verilator": (convert_verilator, ThreadPoolExecutor),
+}
+
+
+def merged_info_name(dat_file, merge_name):
+    """Name of the aggregate *.info file the given *.dat file is merged into.
+    Files are grouped by the coverage type suffix, e.g. `coverage_test_3_branch.dat`
+    is merged into `coverage_<merge_name>_branch.info`. Files without a known
+    coverage type suffix are all merged into `coverage_<merge_name>.info`."""
+    stem = Path(dat_file).stem
+    for cov_type in COVERAGE_TYPES:
+        if stem.endswith(f"_{cov_type}"):
+            return f"coverage_{merge_name}_{cov_type}.info"
+    return f"coverage_{merge_name}.info"
+
+
+def get_converter_version(converter="verilator"):
+    """Returns the version string of the given converter,
+    or None if it cannot be determined."""
+    if converter == "native":
+        return f"sitespawner-native {NATIVE_CONVERTER_VERSION}"
+
+    try:
+        res = subprocess.run(
+            ["verilator_coverage", "--version"],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return res.stdout.strip()
+
+
+def load_manifest(manifest_path, converter):
+    """Loads the conversion manifest. Returns an empty one if it doesn't exist,
+    is malformed or was produced by a different converter version."""
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        manifest = {}
+
+    if manifest.get("converter") != converter:
+        logger.debug(f"Converter changed: {manifest.get('converter')} -> {converter}")
+        manifest = {}
+    return manifest.get("outputs", {})
+
+
+def save_manifest(manifest_path, converter, outputs):
+    """Stores the conversion manifest."""
+    with open(manifest_path, "w") as f:
+        json.dump({"converter": converter, "outputs": outputs}, f, indent=1, sort_keys=True)
+
+
+def stamp_inputs(dat_files, base_dir, recorded=None):
+    """Describes `dat_files` by their size, modification time and content hash.
+    The hash is only computed when size or mtime differ from the `recorded` stamp."""
+    recorded = recorded or {}
+    stamps = {}
+    for dat_file in dat_files:
+        key = os.path.relpath(dat_file, base_dir)
+        st = Path(dat_file).stat()
+        old = recorded.get(key)
+        if old and old[:2] == [st.st_size, st.st_mtime_ns]:
+            stamps[key] = old
+        else:
+            stamps[key] = [st.st_size, st.st_mtime_ns, file_digest(dat_file)]
+    return stamps
+
+
+def is_up_to_date(recorded, stamps):
+    """Compares recorded input stamps with the current ones, ignoring mtimes
+    of files whose contents didn't change."""
+    if recorded is None or recorded.keys() != stamps.keys():
+        return False
+    return all(
+        recorded[key][0] == stamp[0] and recorded[key][2:] == stamp[2:]
+        for key, stamp in stamps.items()
+    )
+
+
+def prune_outputs(outputs, keep, base_dir):
+    """Removes *.info files recorded in the manifest which are no longer produced."""
+    for key in sorted(outputs.keys() - keep):
+        info_path = Path(base_dir) / key
+        if info_path.exists():
+            logger.debug(f"Removing stale {info_path}")
+            info_path.unlink()
+        del outputs[key]
+
 
 @args_on_debug_logger(logger=logger)
-def convert_coverage_data(dat_dir, out_dir, dat_pattern="coverage*.dat"):
-    """Converts *.dat coverage data files into *.info files."""
+def convert_coverage_data(
+    dat_dir,
+    out_dir,
+    dat_pattern="coverage*.dat",
+    *,
+    jobs=None,
+    incremental=False,
+    converter="native",
+    merge_name=None,
+):
+    """Converts *.dat coverage data files into *.info files.
+
+    Conversions are run in a pool of `jobs` workers (CPU count by default).
+    A failed conversion doesn't stop the remaining ones, all failures
+    are reported together once the pool is drained.
+
+    In the `incremental` mode, a manifest of converted inputs is kept next to
+    the output and only *.info files with changed inputs are regenerated.
+    *.info files whose *.dat files disappeared are removed.
+
+    `converter` selects between the built-in *.dat reader ("native")
+    and the external `verilator_coverage` tool ("verilator").
+
+    If `merge_name` is given, *.dat files are merged per coverage type
+    into `coverage_<merge_name>_<type>.info` files instead of being converted one by one."""
     dat_dir = Path(dat_dir)
 
     # Find all coverage*.dat files
-    files = list(Path.glob(dat_dir, f"**/{dat_pattern}"))
+    files = sorted(Path.glob(dat_dir, f"**/{dat_pattern}"))
 
     if not files:
         logger.error("No 'coverage*.dat' files were found.")
@@ -25,24 +324,77 @@ def convert_coverage_data(dat_dir, out_dir, dat_pattern="coverage*.dat"):
         msg = "No 'coverage*.dat' data files were found."
         raise Exception(msg)
 
+    conversions = {}
     for dat_file in files:
-        info_filename = dat_file.name.replace(".dat", ".info")
-        info_path = (dat_file.parent if not out_dir else Path(out_dir)) / info_filename
+        if merge_name:
+            info_path = Path(out_dir or dat_dir) / merged_info_name(dat_file, merge_name)
+        else:
+            info_filename = dat_file.name.replace(".dat", ".info")
+            info_path = (dat_file.parent if not out_dir else Path(out_dir)) / info_filename
+        conversions.setdefault(info_path, []).append(dat_file)
 
-        try:
-            subprocess.run(
-                [
-                    "verilator_coverage",
-                    "--write-info",
-                    info_path,
-                    dat_file,
-                ],
-                check=True,
-            )
-            logger.debug(f"Conversion: {dat_file} -> {info_path} SUCCEEDED")
-        except subprocess.CalledProcessError as e:
-            msg = f"Failed to convert {dat_file}"
-            raise Exception(msg) from e
+    if incremental:
+        manifest_dir = Path(out_dir) if out_dir else dat_dir
+        manifest_path = manifest_dir / MANIFEST_NAME
+        converter_version = get_converter_version(converter)
+        outputs = load_manifest(manifest_path, converter_version)
+
+        stamps = {}
+        for info_path, dat_files in conversions.items():
+            key = os.path.relpath(info_path, manifest_dir)
+            recorded = outputs.get(key)
+            stamps[info_path] = stamp_inputs(dat_files, manifest_dir, recorded)
+            if info_path.exists() and is_up_to_date(recorded, stamps[info_path]):
+                # Refresh stamps in case only the modification times changed
+                outputs[key] = stamps[info_path]
+            else:
+                outputs.pop(key, None)
+
+        keep = {os.path.relpath(info_path, manifest_dir) for info_path in conversions}
+        prune_outputs(outputs, keep, manifest_dir)
+
+        skipped = len(conversions)
+        conversions = {
+            info_path: dat_files
+            for info_path, dat_files in conversions.items()
+            if os.path.relpath(info_path, manifest_dir) not in outputs
+        }
+        skipped -= len(conversions)
+        logger.info(f"{skipped} *.info files are up to date, {len(conversions)} to convert")
+
+    jobs = jobs or os.cpu_count() or 1
+    logger.debug(f"Converting {len(conversions)} files using {jobs} {converter} workers")
+
+    convert, executor_type = CONVERTERS[converter]
+    failures = []
+    with executor_type(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(run_conversion, convert, dat_files, info_path): info_path
+            for info_path, dat_files in conversions.items()
+        }
+
+        for future, info_path in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(str(e))
+                # Tracebacks of worker processes are attached as the cause
+                logger.debug("".join(traceback.format_exception(type(e), e, e.__traceback__)))
+                failures.append(info_path)
+                continue
+
+            if incremental:
+                outputs[os.path.relpath(info_path, manifest_dir)] = stamps[info_path]
+
+    if incremental:
+        save_manifest(manifest_path, converter_version, outputs)
+
+    if failures:
+        logger.error(f"{len(failures)} out of {len(conversions)} conversions failed:")
+        for info_path in failures:
+            logger.error(f"  {info_path}")
+        msg = f"Failed to produce {len(failures)} out of {len(conversions)} *.info files."
+        raise Exception(msg)
 
 
 @main_func_log(logger, "Convert Coverage Data: *.dat -> *.info")
@@ -53,4 +405,11 @@ def convert_data(args):
     if out_dir:
         Path(out_dir).mkdir(parents=True, exist_ok=True)
 
-    convert_coverage_data(dat_dir, out_dir)
+    convert_coverage_data(
+        dat_dir,
+        out_dir,
+        jobs=args.jobs,
+        incremental=args.incremental,
+        converter=args.converter,
+        merge_name=args.merge,
+    )
@@ -2,66 +2,135 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
-import logging
-import subprocess
-from io import TextIOWrapper
+import datetime
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 from shutil import copy2
-from typing import List
 
-from sitespawner.common import args_on_debug_logger, get_logger, main_func_log, styles_dir
-from sitespawner.genhtml import genhtml, get_common_src_path, parse_infos
+import git
+
+from sitespawner.common import (
+    args_on_debug_logger,
+    file_digest,
+    get_logger,
+    main_func_log,
+    styles_dir,
+)
+from sitespawner.compress import compress_tree
+from sitespawner.genhtml import genhtml, get_common_src_path, resolve_path
+from sitespawner.render import set_bytecode_cache_dir
+from sitespawner.tracefile import (
+    DEFAULT_CACHE_SIZE,
+    DEFAULT_MERGE_FAN_IN,
+    merge_tracefiles,
+    tracefile_cache,
+)
 
 logger = get_logger(__name__)
 
+# Assets shared by all dashboards of the report directory
+ASSETS_DIR = "_assets"
+STYLESHEET = styles_dir / "cov.css"
+LOGO = styles_dir / "assets" / "chips-alliance-logo-mono.svg"
+TABLE_SCRIPT = styles_dir / "cov-table.js"
+
+
+def get_build_time(reproducible=False):
+    """Time stamped on the generated pages. SOURCE_DATE_EPOCH takes precedence,
+    in the reproducible mode the time of the current git commit is used otherwise."""
+    source_date_epoch = os.getenv("SOURCE_DATE_EPOCH")
+    if source_date_epoch:
+        return datetime.datetime.fromtimestamp(int(source_date_epoch), tz=datetime.timezone.utc)
+
+    if not reproducible:
+        return datetime.datetime.now()
+
+    try:
+        commit = git.Repo(search_parent_directories=True).head.commit
+    except (git.InvalidGitRepositoryError, ValueError) as e:
+        msg = "Reproducible mode requires SOURCE_DATE_EPOCH or a git repository with commits"
+        raise ValueError(msg) from e
+    return commit.committed_datetime.astimezone(datetime.timezone.utc)
+
+
+def publish_asset(src, assets_dir, name=None):
+    """Places the asset in `assets_dir` under a name derived from its contents, so that
+    pages referencing it never pick up a different version. Returns the name.
+    The asset is copied, as hardlinks to the installed package would spread into the webpage."""
+    stem, suffix = os.path.splitext(name or Path(src).name)
+    asset_name = f"{stem}.{file_digest(src)[:12]}{suffix}"
+    asset_path = Path(assets_dir) / asset_name
+    # Assets hardlinked to the package by earlier versions are replaced with copies as well
+    if not asset_path.exists() or asset_path.samefile(src):
+        logger.debug(f"Publish {src} as {asset_path}")
+        asset_path.unlink(missing_ok=True)
+        copy2(src, asset_path)
+    return asset_name
+
+
+def generate_test_report(
+    input_files,
+    output_dir,
+    src_path,
+    test_name,
+    project_name,
+    *,
+    logo_src,
+    logo_href,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    timestamp=None,
+    stylesheet="cov.css",
+    table_mode="html",
+    table_script=None,
+):
+    """Generates a coverage dashboard from the given *.info files in `output_dir`."""
+    tracefile_cache.configure(cache_dir, cache_size)
+    if cache_dir:
+        set_bytecode_cache_dir(cache_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
 
-def obtain_stdout(filename) -> TextIOWrapper | int:
-    """Checks whether the logger is in debug mode. If it is
-    then returns a file descriptor to the file with the given filename.
-    Otherwise, returns subprocess.DEVNULL."""
-    if logger.getEffectiveLevel() <= logging.DEBUG:
-        return open(filename, "w+")
-    return subprocess.DEVNULL
-
+    genhtml(
+        input_files=input_files,
+        output_dir=output_dir,
+        src_path=src_path,
+        project_name=project_name,
+        test_name=test_name,
+        logo_src=logo_src,
+        logo_href=logo_href,
+        timestamp=timestamp,
+        stylesheet=stylesheet,
+        table_mode=table_mode,
+        table_script=table_script,
+    )
 
-def lcov_merge(input_files: List[str], output_file: str):
-    """Invokes lcov tool to add `input_file` into the tracefile.
-    `output_file` becomes then an aggregate of *.info files."""
-    lcov_command = ["lcov", "-o", output_file]
 
-    for input_file in input_files:
-        lcov_command += ["-a", input_file]
+def generate_merged_report(
+    branch_files, toggle_files, branch_merged, toggle_merged, merge_fan_in, **report_args
+):
+    """Merges *.info files of all tests and generates the combined coverage dashboard.
+    Intermediate merge results are spilled into a private temporary directory."""
+    merged_input_files = []
 
-    subprocess.run(
-        lcov_command,
-        stdout=obtain_stdout(f"{output_file}_merge.log"),
-        check=False,
-    )
+    with tempfile.TemporaryDirectory(prefix="sis-all-") as scratch_dir:
+        # Merge branch files
+        if branch_files:
+            merge_tracefiles(
+                branch_files, branch_merged, fan_in=merge_fan_in, spill_dir=scratch_dir
+            )
+            merged_input_files.append(str(branch_merged))
 
+        # Merge toggle files
+        if toggle_files:
+            merge_tracefiles(
+                toggle_files, toggle_merged, fan_in=merge_fan_in, spill_dir=scratch_dir
+            )
+            merged_input_files.append(str(toggle_merged))
 
-@args_on_debug_logger(logger=logger)
-def lcov_genhtml(
-    info_files,
-    path_prefix,
-    lcov_report_dir="lcov_report",
-    log_output_path="lcov_genhtml.log",
-):
-    """Invokes lcov's genhtml tool to generate source file views for the coverage report."""
-    command = ["genhtml", "--output-dir", lcov_report_dir, *info_files]
-
-    if not path_prefix:
-        subprocess.run(
-            command,
-            stdout=obtain_stdout(log_output_path),
-            check=False,
-        )
-    else:
-        command += ["--prefix", str(Path(path_prefix).resolve())]
-        subprocess.run(
-            command,
-            stdout=obtain_stdout(log_output_path),
-            check=False,
-        )
+    # Generate final combined report
+    generate_test_report(input_files=merged_input_files, test_name="all", **report_args)
 
 
 @args_on_debug_logger(logger=logger)
@@ -75,11 +144,23 @@ def generate_coverage_reports(
     info_report_dir=None,
     project_name="Project",
     info_pattern="coverage*.info",
+    *,
+    merge_fan_in=DEFAULT_MERGE_FAN_IN,
+    jobs=None,
+    cache_dir=None,
+    cache_size=DEFAULT_CACHE_SIZE,
+    reproducible=False,
+    table_mode="html",
 ):
     """Iterates over available *.info files, merges them & generates summaries
-    for each coverage type with the use of lcov.
+    for each coverage type.
     Calls `genhtml` to generate coverage dashboards for individual tests as
-    well as for the all tests combined."""
+    well as for the all tests combined, in a pool of `jobs` worker processes.
+    Parsed *.info files are cached in `cache_dir`, limited to `cache_size` MiB.
+    In the `reproducible` mode identical inputs produce identical dashboards.
+    In the json `table_mode` coverage tables are rendered in the browser."""
+    tracefile_cache.configure(cache_dir, cache_size)
+
     curr_dir = Path.cwd()
     if not info_report_dir:
         info_report_dir = curr_dir
@@ -89,21 +170,20 @@ def generate_coverage_reports(
         raise ValueError(msg)
 
     # Extract coverage info files
-    info_files = list(Path(info_report_dir).glob(f"**/{info_pattern}"))
+    info_files = sorted(Path(info_report_dir).glob(f"**/{info_pattern}"))
     processed_info = False
 
     for info_file in info_files:
         logger.debug(f"Preprocessing {info_file}")
-        lcov_extract_command = ["lcov", "--extract", info_file, src_pattern, "-o", info_file]
 
-        data = parse_infos([str(info_file)])
-        if len(data.keys()) == 0:
+        tracefile = tracefile_cache.load(info_file)
+        if not tracefile.files:
             logger.warning(f"No data found in .info file: {info_file}")
             continue
 
         processed_info = True
-        path_prefix = get_common_src_path(data.keys())
-        resolved_src_path = Path(src_path).resolve()
+        path_prefix = get_common_src_path(tracefile.files.keys())
+        resolved_src_path = resolve_path(src_path)
 
         # Align paths to end in the same directory:
         parts = path_prefix.parts
@@ -113,26 +193,21 @@ def generate_coverage_reports(
                 break
             path_prefix = path_prefix.parent
 
-        resolved_path_prefix = Path(path_prefix).resolve()
+        resolved_path_prefix = resolve_path(path_prefix)
         logger.debug(f"Deduced source path prefix: {path_prefix}")
+        substitute = None
         if resolved_src_path != resolved_path_prefix:
             logger.debug(f"Substituting prefix: {path_prefix} -> {resolved_src_path}")
-            lcov_extract_command += [
-                "--substitute",
-                f"s|{path_prefix}|{resolved_src_path}|",
-            ]
-
-        subprocess.run(
-            lcov_extract_command,
-            stdout=obtain_stdout(f"{info_file}_extraction.log"),
-            check=False,
+            substitute = (str(path_prefix), str(resolved_src_path))
+
+        # Equivalent of `lcov --extract` and `lcov --remove`, done in a single pass
+        tracefile = tracefile.filter(
+            include=[src_pattern],
+            exclude=src_remove_pattern,
+            substitute=substitute,
         )
-        if src_remove_pattern is not None:
-            subprocess.run(
-                ["lcov", "--remove", info_file, *src_remove_pattern, "-o", info_file],
-                stdout=obtain_stdout(f"{info_file}_remove.log"),
-                check=False,
-            )
+        tracefile.write(info_file)
+        tracefile_cache.store(info_file, tracefile)
 
     if not processed_info:
         logger.error("No valid 'coverage*.info' data files were found.")
@@ -140,14 +215,13 @@ def generate_coverage_reports(
         msg = "No valid 'coverage*.info' data files were found."
         raise Exception(msg)
 
-    # Run LCOV's genhtml to gather source-file pages
+    # Merged tracefiles of all tests
     branch_merged = Path("./merged_branch.info")
     toggle_merged = Path("./merged_toggle.info")
-    lcov_genhtml_output_merged_log = Path("./lcov_genhtml_merged.out")
 
     # Find and classify coverage files
     branch_files, toggle_files = {}, {}
-    files = Path(info_report_dir).glob("**/coverage_*.info")
+    files = sorted(Path(info_report_dir).glob("**/coverage_*.info"))
     file_names = set()
 
     for file in files:
@@ -158,80 +232,73 @@ def generate_coverage_reports(
             file_names.add(file.name.removesuffix("_toggle.info"))
             toggle_files[file.name.removesuffix("_toggle.info")] = file
 
-    # Generate reports for each coverage file set
-    for name_body in file_names:
-        input_files = []
-        if name_body in toggle_files:
-            input_files.append(str(toggle_files[name_body]))
-        if name_body in branch_files:
-            input_files.append(str(branch_files[name_body]))
-        test_name = name_body.removeprefix("coverage_")
-
-        test_output_dir = Path(output_dir) / f"all_{test_name}"
-        (test_output_dir / "_static").mkdir(parents=True, exist_ok=True)
-
-        info_files = Path(info_report_dir).glob(f"**/*{test_name}*.info")
-        lcov_html_dir = curr_dir / "lcov_report"
-
-        lcov_genhtml_output_name = Path(f"./lcov_genhtml_{test_name}.log")
-        lcov_genhtml(info_files, src_path, lcov_html_dir, lcov_genhtml_output_name)
-        genhtml(
-            input_files=input_files,
-            output_dir=test_output_dir,
-            src_path=src_path,
-            project_name=project_name,
-            test_name=test_name,
-            logo_src=logo_src,
-            logo_href=logo_href,
-            html_src_dir=lcov_html_dir,
-        )
-
-        copy2(styles_dir / "main.css", test_output_dir)
-        copy2(styles_dir / "cov.css", test_output_dir)
-        copy2(
-            styles_dir / "assets" / "chips-alliance-logo-mono.svg",
-            test_output_dir / "_static" / "white.svg",
-        )
-
-    # Merge branch files
-    merged_input_files = []
-
-    if branch_files:
-        lcov_merge(branch_files.values(), branch_merged)
-        merged_input_files.append(str(branch_merged))
+    # Generate reports for each coverage file set. The combined report is the largest one,
+    # so it is submitted first to overlap with the per-test dashboards.
+    report_args = {
+        "src_path": src_path,
+        "project_name": project_name,
+        "logo_src": logo_src,
+        "logo_href": logo_href,
+        "cache_dir": cache_dir,
+        "cache_size": cache_size,
+        "timestamp": get_build_time(reproducible),
+        "table_mode": table_mode,
+    }
+
+    # Styles & the logo are published once, dashboards refer to them relatively
+    assets_dir = Path(output_dir) / ASSETS_DIR
+    assets_dir.mkdir(parents=True, exist_ok=True)
+    report_args["stylesheet"] = f"../{ASSETS_DIR}/{publish_asset(STYLESHEET, assets_dir)}"
+    if not logo_src:
+        logo_name = publish_asset(LOGO, assets_dir, name="white.svg")
+        report_args["logo_src"] = f"../{ASSETS_DIR}/{logo_name}"
+    if table_mode == "json":
+        report_args["table_script"] = f"../{ASSETS_DIR}/{publish_asset(TABLE_SCRIPT, assets_dir)}"
+
+    failures = []
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) as executor:
+        futures = {
+            executor.submit(
+                generate_merged_report,
+                branch_files=list(branch_files.values()),
+                toggle_files=list(toggle_files.values()),
+                branch_merged=branch_merged,
+                toggle_merged=toggle_merged,
+                output_dir=Path(output_dir) / "all",
+                merge_fan_in=merge_fan_in,
+                **report_args,
+            ): "all"
+        }
+
+        for name_body in sorted(file_names):
+            input_files = []
+            if name_body in toggle_files:
+                input_files.append(str(toggle_files[name_body]))
+            if name_body in branch_files:
+                input_files.append(str(branch_files[name_body]))
+            test_name = name_body.removeprefix("coverage_")
+
+            future = executor.submit(
+                generate_test_report,
+                input_files=input_files,
+                output_dir=Path(output_dir) / f"all_{test_name}",
+                test_name=test_name,
+                **report_args,
+            )
+            futures[future] = test_name
 
-    # Merge toggle files
-    if toggle_files:
-        lcov_merge(toggle_files.values(), toggle_merged)
-        merged_input_files.append(str(toggle_merged))
+        for future, test_name in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to generate the coverage dashboard for {test_name}: {e}")
+                failures.append(test_name)
 
-    # Generate final combined report
-    final_output_dir = Path(output_dir) / "all"
-    (final_output_dir / "_static").mkdir(parents=True, exist_ok=True)
-
-    lcov_genhtml(
-        merged_input_files,
-        src_path,
-        lcov_html_dir,
-        lcov_genhtml_output_merged_log,
-    )
-    genhtml(
-        input_files=merged_input_files,
-        output_dir=final_output_dir,
-        src_path=src_path,
-        project_name=project_name,
-        test_name="all",
-        logo_src=logo_src,
-        logo_href=logo_href,
-        html_src_dir=lcov_html_dir,
-    )
+    tracefile_cache.trim()
 
-    copy2(styles_dir / "main.css", final_output_dir)
-    copy2(styles_dir / "cov.css", final_output_dir)
-    copy2(
-        styles_dir / "assets" / "chips-alliance-logo-mono.svg",
-        final_output_dir / "_static" / "white.svg",
-    )
+    if failures:
+        msg = f"Failed to generate {len(failures)} coverage dashboards: {', '.join(failures)}"
+        raise Exception(msg)
 
 
 @main_func_log(logger, "Generate Coverage Reports")
@@ -250,4 +317,13 @@ def main(args):
         info_report_dir=args.info_report_dir,
         project_name=args.src_project_name,
         info_pattern=args.info_pattern,
+        merge_fan_in=args.merge_fan_in,
+        jobs=args.jobs,
+        cache_dir=args.cache_dir,
+        cache_size=args.cache_size,
+        reproducible=args.reproducible,
+        table_mode=args.table_mode,
     )
+
+    if args.compress:
+        compress_tree(report_dir, jobs=args.jobs, min_size=args.compress_min_size)
@@ -2,29 +2,48 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import filecmp
 from pathlib import Path
 from shutil import copy
 
-import jinja2
-
 from sitespawner.common import args_on_debug_logger, get_logger
+from sitespawner.render import render_if_changed
 
 logger = get_logger(__name__)
 
 
-def render_template(src, dst, **kwargs):
+def render_template(name, dst, **kwargs):
     """
-    Renders a jinja2 template file to another file
+    Renders a jinja2 template of the given name to a file.
+    The file is left untouched if its contents wouldn't change.
     """
-    with open(src) as fr, open(dst, "w") as fw:
-        tpl = jinja2.Template(fr.read())
-        fw.write(tpl.render(**kwargs))
+    if render_if_changed(name, dst, kwargs, trailing_newline=False):
+        logger.debug(f"Updated {dst}")
+    return dst
+
+
+def copy_if_changed(src, dst):
+    """Copies `src` to `dst` unless they're already identical."""
+    if not dst.is_file() or not filecmp.cmp(src, dst, shallow=False):
+        copy(src, dst)
+        logger.debug(f"Updated {dst}")
+    return dst
+
+
+def remove_stale_sources(output, sources):
+    """Removes pages in `output` which weren't generated in this run,
+    e.g. of branches which are no longer present in the webpage."""
+    for path in sorted(output.rglob("*.md"), reverse=True):
+        if path not in sources:
+            logger.debug(f"Removing stale {path}")
+            path.unlink()
+    for path in sorted(output.rglob("*"), reverse=True):
+        if path.is_dir() and not any(path.iterdir()):
+            path.rmdir()
 
 
 @args_on_debug_logger(logger)
-def make_coverage_report_index(
-    branch, root, output, templates, include_documentation  # noqa: ARG001
-):
+def make_coverage_report_index(branch, root, output, include_documentation):  # noqa: ARG001
     """Prepares coverage report index page."""
     # Coverage types individual dashboards accumulate
     # Coverage dashboard displays coverage types side-by-side
@@ -67,29 +86,33 @@ def make_coverage_report_index(
     }
 
     output.mkdir(parents=True, exist_ok=True)
-    render_template(
-        templates / "coverage_dashboard.md",
+    return render_template(
+        "coverage_dashboard.md",
         output / "coverage_dashboard.md",
         **params,
     )
 
 
 @args_on_debug_logger(logger)
-def make_dev_index(branches, output, templates, include_documentation):
+def make_dev_index(branches, output, include_documentation):
     """Prepares the branch/pr index page."""
     params = {"branches": branches, "include_documentation": include_documentation}
-    render_template(templates / "dev.md", output / "dev.md", **params)
+    return render_template("dev.md", output / "dev.md", **params)
 
 
 def generate(template, root, output, include_documentation):
-    """Processes webpage *.md templates."""
+    """Processes webpage *.md templates. Only sources whose contents changed are rewritten
+    and sources of removed branches are deleted, so that the `output` directory can be kept
+    between runs and Sphinx only rebuilds the affected pages."""
     template = Path(template)
     root = Path(root)
     output = Path(output)
+    output.mkdir(parents=True, exist_ok=True)
+    sources = set()
 
     # Reports for the main branch
-    make_coverage_report_index(
-        "main", root / "main", output / "main", template, include_documentation
+    sources.add(
+        make_coverage_report_index("main", root / "main", output / "main", include_documentation)
     )
 
     # Reports for development branches / pull requests
@@ -98,23 +121,29 @@ def generate(template, root, output, include_documentation):
     path = root / "dev"
 
     if path.is_dir():
-        for filepath in path.iterdir():
+        for filepath in sorted(path.iterdir()):
             if not filepath.is_dir():
                 continue
 
             fname = filepath.name
             branches.append(fname)
-            make_coverage_report_index(
-                fname, root / "dev" / fname, output / "dev" / fname, template, include_documentation
+            sources.add(
+                make_coverage_report_index(
+                    fname, root / "dev" / fname, output / "dev" / fname, include_documentation
+                )
             )
 
     # Prepare the branch/pr index page
-    make_dev_index(branches, output, template, include_documentation)
-    render_template(
-        template / "main.md", output / "main.md", **{"include_documentation": include_documentation}
+    sources.add(make_dev_index(branches, output, include_documentation))
+    sources.add(
+        render_template(
+            "main.md", output / "main.md", **{"include_documentation": include_documentation}
+        )
     )
 
     # Copy other files/pages
     files = ["conf.py", "index.md"]
     for file in files:
-        copy(template / file, output / file)
+        sources.add(copy_if_changed(template / file, output / file))
+
+    remove_stale_sources(output, sources)
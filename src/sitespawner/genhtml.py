@@ -3,24 +3,27 @@
 # SPDX-License-Identifier: Apache-2.0
 
 import datetime
-from collections import OrderedDict, defaultdict
-from copy import deepcopy
+import hashlib
+import json
+from collections import defaultdict
+from functools import lru_cache
 from os.path import commonpath
 from pathlib import Path
-from typing import List
-
-from bs4 import BeautifulSoup as BS
-from jinja2 import Environment, FileSystemLoader
 
 from sitespawner.common import (
     args_on_debug_logger,
-    coverage_dashboard_template_dir,
+    atomic_write,
+    file_digest,
     get_logger,
     main_func_log,
 )
+from sitespawner.render import render_to_file, template_env, template_version
+from sitespawner.tracefile import tracefile_cache
 
 logger = get_logger(__name__)
 
+REPORT_MANIFEST_NAME = ".sis_report_manifest.json"
+
 
 def gradient(percentage):
     def hex_to_rgb(hex_color):
@@ -57,56 +60,63 @@ def get_color(value: float, total_points: int, min_value: float = 0, max_value:
     return gradient(frac)
 
 
+template_env.globals["get_color"] = get_color
+
+
 # Summary parsing # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
+@lru_cache(maxsize=None)
+def resolve_path(path) -> Path:
+    """Resolves `path` once per process, the same source paths recur in every tracefile."""
+    return Path(path).resolve()
+
+
+@lru_cache(maxsize=None)
+def relative_parts(path, root: Path):
+    """Segments of the resolved `path` relative to `root`."""
+    return resolve_path(path).relative_to(root).parts
+
+
 def get_common_src_path(paths):
     """Longest common path of given `paths`."""
-    return Path(commonpath([Path(x).resolve() for x in paths if Path(x).is_absolute()]))
-
+    return Path(commonpath([resolve_path(x) for x in paths if Path(x).is_absolute()]))
 
-def parse_infos(input_files: List[str]):
-    for file in input_files:
-        if not Path(file).is_file():
-            msg = f"Input file '{file}' does not exist."
-            raise FileNotFoundError(msg)
 
+def summarize_tracefiles(tracefiles):
+    """Summarizes line coverage of each source file in parsed tracefiles,
+    given as a dict mapping tracefile names to their contents.
+    The coverage type of each tracefile is deduced from the suffix of its name."""
     data = defaultdict(defaultdict)
 
-    for i in input_files:
-        lines_found_sum = 0
-        lines_hit_sum = 0
+    for i, tracefile in tracefiles.items():
         module_name, _ = i.split("_")[-1].split(".")
 
-        with open(i) as f:
-            file_path = None
-            lines_found = None
-            lines_hit = None
-            for line in f:
-                if line.startswith("SF:"):
-                    file_path = line[3:].strip()
-                elif line.startswith("LF:"):
-                    lines_found = int(line[3:])
-                    lines_found_sum += lines_found
-                elif line.startswith("LH:"):
-                    lines_hit = int(line[3:])
-                    lines_hit_sum += lines_hit
-                elif line.startswith("end_of_record"):
-                    data[file_path][module_name] = [lines_hit, lines_found]
-                    file_path = None
-                    lines_found = None
-                    lines_hit = None
-
-        data["Total:"][module_name] = [lines_hit_sum, lines_found_sum]
+        for file_path, record in tracefile.files.items():
+            data[file_path][module_name] = [record.lines_hit, record.lines_found]
+
+        data["Total:"][module_name] = [tracefile.lines_hit, tracefile.lines_found]
     return data
 
 
+def combine_line_hits(tracefiles, file):
+    """Sums line hit counts of the source file across all tracefiles."""
+    line_hits = {}
+    for tracefile in tracefiles:
+        record = tracefile.files.get(file)
+        if record is None:
+            continue
+        for line, hits in zip(record.lines, record.line_hits):
+            line_hits[line] = line_hits.get(line, 0) + hits
+    return line_hits
+
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # HTML components generation # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-def generate_table(data, template_env, links=False):
-    """Generates coverage table component."""
+def generate_table(data, hrefs):
+    """Prepares the context of the coverage table component (main_table.html)."""
     cov_types = sorted(next(iter(data.items()))[1].keys(), reverse=True)
     num_tests = len(cov_types)
     raw_widths = [40, 20, 20]
@@ -117,39 +127,39 @@ def generate_table(data, template_env, links=False):
     hit_w = cov_container_size / 4
     rate_w = cov_container_size - hit_w
 
-    template_env.globals["get_color"] = get_color
-    main_table_html = template_env.get_template("main_table.html")
     # Only pass actual coverage data, leave out the summary
     # The hit rates also have to be sorted in the same way cov_types are
     cov_data = {
         k: dict(sorted(v.items(), reverse=True)) for (k, v) in data.items() if k != "Total:"
     }
-    return main_table_html.render(
-        cov_types=cov_types,
-        width_cov_desc=sum(raw_widths) / num_tests,
-        name_w=name_w,
-        rate_w=rate_w,
-        hit_w=hit_w,
-        data=cov_data,
-        widths_arr=widths_arr,
-        links=links,
-    )
+    return {
+        "cov_types": cov_types,
+        "width_cov_desc": sum(raw_widths) / num_tests,
+        "name_w": name_w,
+        "rate_w": rate_w,
+        "hit_w": hit_w,
+        "data": cov_data,
+        "widths_arr": widths_arr,
+        "hrefs": hrefs,
+    }
+
 
+def generate_table_data(data, hrefs):
+    """Prepares the columnar coverage table payload rendered in the browser by cov-table.js."""
+    cov_types = sorted(next(iter(data.values())).keys(), reverse=True)
+    names = [name for name in data if name != "Total:"]
+    return {
+        "types": cov_types,
+        "names": names,
+        "hrefs": [hrefs.get(name) for name in names],
+        "hit": {key: [data[name][key][0] for name in names] for key in cov_types},
+        "total": {key: [data[name][key][1] for name in names] for key in cov_types},
+    }
 
-def generate_summary(data: list, key: str, template_env: Environment, new_row=False):
-    """Generates coverage summary table component that then is included next to the info header."""
-    summary_html = template_env.get_template("summary_table.html")
 
-    frac = data[0] / data[1] * 100 if data[1] != 0 else 0
-    full_cov_color = get_color(data[0], data[1])
-    return summary_html.render(
-        new_row=new_row,
-        cov_type_token=key,
-        color_token=full_cov_color,
-        hitrate_token=f"{frac:.1f}%",
-        hit_token=str(data[0]),
-        total_token=str(data[1]),
-    )
+def table_data_name(page):
+    """Name of the coverage table payload of the page (--table-mode json)."""
+    return str(Path(page).with_suffix(".json"))
 
 
 def render_page(
@@ -160,31 +170,48 @@ def render_page(
     test_name,
     logo_src,
     logo_href,
-    template_env,
     project_name,
-    links=True,
+    *,
+    hrefs,
+    time_token,
+    stylesheet,
+    table_mode="html",
+    table_script=None,
 ):
-    """Combines the final report page."""
-    report_html = template_env.get_template("coverage_report.html")
-
-    output = report_html.render(
-        header_token="Full",
-        project_name=project_name,
-        logo_src=logo_src,
-        logo_href=logo_href,
-        fulltable_token=generate_table(data, template_env, links),
-        root_name=root_name,
-        path_segments=path_segments,
-        testname_token=test_name,
-        time_token=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
-        **{
-            f"{test}_summary_token": generate_summary(data["Total:"][test], test, template_env)
-            for test in data["Total:"].keys()
-        },
-    )
+    """Combines the final report page, rows of the table link to `hrefs` of their names.
+    In the json `table_mode` the table is rendered in the browser by `table_script`
+    from the payload stored next to the page."""
+    context = {
+        "header_token": "Full",
+        "project_name": project_name,
+        "logo_src": logo_src,
+        "logo_href": logo_href,
+        "root_name": root_name,
+        "path_segments": path_segments,
+        "testname_token": test_name,
+        "time_token": time_token,
+        "stylesheet": stylesheet,
+        "summary": data["Total:"],
+    }
+
+    if table_mode == "json":
+        data_path = table_data_name(out_dir)
+        with atomic_write(data_path) as f:
+            json.dump(generate_table_data(data, hrefs), f, separators=(",", ":"))
+        context["table_data"] = Path(data_path).name
+        context["table_script"] = table_script
+    else:
+        context.update(generate_table(data, hrefs))
 
-    with open(out_dir, "w") as f:
-        print(output, file=f)
+    render_to_file("coverage_report.html", out_dir, context)
+
+
+def read_source_lines(file, line_hits):
+    """Yields (line number, hit count, text) for each line of the source file.
+    Hit count is None for lines without coverage data."""
+    with open(file, errors="replace") as src:
+        for lineno, text in enumerate(src, start=1):
+            yield lineno, line_hits.get(lineno), text.rstrip("\r\n").expandtabs(8)
 
 
 def sub_src_view(
@@ -193,100 +220,168 @@ def sub_src_view(
     test_name,
     root_name,
     path_segments,
-    src_prefix,
     out_dir,
-    html_src_dir,
+    line_hits,
     logo_src,
     logo_href,
     project_name,
-    template_env,
+    *,
+    time_token,
+    stylesheet,
 ):
-    """Generate page for the source file based on the view generated by lcov's genhtml."""
-    file = Path(file).resolve()
-
-    inner_path = file.relative_to(src_prefix).parent
-    html_name = f"{file.name}.gcov.html"
-
-    main_table = None
-    src_html_path = Path(html_src_dir) / inner_path / html_name
+    """Generate page for the source file annotated with `line_hits` counts."""
+    file = resolve_path(file)
 
-    if not src_html_path.exists():
-        logger.warning(f"Not found: {src_html_path}")
+    if not file.is_file():
+        logger.warning(f"Not found: {file}")
         return
 
-    with open(src_html_path) as src:
-        soup = BS(src, features="html.parser")
-        elem = soup.findAll("table")
-        main_table = elem[len(elem) - 2]
-
-    report_html = template_env.get_template("src_view.html")
-
     logger.debug(f"Generate summary for file {file.name}")
 
-    output = report_html.render(
-        header_token="Full",
-        project_name=project_name,
-        logo_src=logo_src,
-        logo_href=logo_href,
-        root_name=root_name,
-        path_segments=path_segments,
-        src_file_table=main_table,
-        testname_token=test_name,
-        time_token=datetime.datetime.now().strftime("%d-%m-%Y %H:%M:%S"),
-        **{
-            f"{test}_summary_token": generate_summary(data[test], test, template_env)
-            for test in data.keys()
-        },
-    )
-
-    with open(out_dir, "w") as f:
-        print(output, file=f)
+    context = {
+        "header_token": "Full",
+        "project_name": project_name,
+        "logo_src": logo_src,
+        "logo_href": logo_href,
+        "root_name": root_name,
+        "path_segments": path_segments,
+        "src_lines": read_source_lines(file, line_hits),
+        "testname_token": test_name,
+        "time_token": time_token,
+        "stylesheet": stylesheet,
+        "summary": data,
+    }
+    render_to_file("src_view.html", out_dir, context)
 
 
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 # Data normalization dependent on the view # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 
-def generate_dir_dict(data, path_to_dir):
-    """Process coverage data grouped by directory/module."""
-    gdict = defaultdict(lambda: defaultdict(list))
-    for file, cov_data in dict(data).items():
+def add_coverage(totals, cov_data):
+    """Adds [hit, total] pairs of `cov_data` to `totals`, per coverage type."""
+    for key, (hit, total) in cov_data.items():
+        rollup = totals.setdefault(key, [0, 0])
+        rollup[0] += hit
+        rollup[1] += total
+
+
+def build_dir_tree(data, code_root_path: Path):
+    """Builds the directory tree of source files, keyed by directory segments relative to
+    `code_root_path` (() being the root). Each node holds its subdirectories ("dirs"),
+    files ("files") and the coverage summed over its whole subtree ("Total:")."""
+    tree = {(): {"dirs": [], "files": {}, "Total:": {}}}
+    for file, cov_data in data.items():
         if file == "Total:":
-            gdict[file] = deepcopy(cov_data)
             continue
 
-        base = Path(file).resolve().parent.relative_to(path_to_dir)
+        base = relative_parts(file, code_root_path)[:-1]
+        if base not in tree:
+            # Attach the directory and its missing ancestors to the tree
+            depth = len(base)
+            while base[: depth - 1] not in tree:
+                depth -= 1
+            for i in range(depth, len(base) + 1):
+                tree[base[:i]] = {"dirs": [], "files": {}, "Total:": {}}
+                tree[base[: i - 1]]["dirs"].append(base[:i])
+
+        tree[base]["files"][file] = cov_data
+        add_coverage(tree[base]["Total:"], cov_data)
+
+    # Roll the totals up, deepest directories first
+    for key in sorted(tree, key=len, reverse=True):
+        if key:
+            add_coverage(tree[key[:-1]]["Total:"], tree[key]["Total:"])
+
+    return dict(sorted(tree.items()))
+
+
+def collapsed_root(tree):
+    """Segments of the directory reached from the root of `tree` by descending through
+    directories which hold no files and a single subdirectory."""
+    key = ()
+    while not tree[key]["files"] and len(tree[key]["dirs"]) == 1:
+        key = tree[key]["dirs"][0]
+    return key
+
+
+def assign_page_names(paths):
+    """Maps directories and files, given as relative path segments, to names of their pages.
+    Names follow the whole relative path, so equally named files in different directories
+    don't clash. Paths that still map to the same name get a suffix derived from the path."""
+    groups = defaultdict(list)
+    for parts in paths:
+        groups["_".join(parts)].append(parts)
+
+    pages = {}
+    for name, group in groups.items():
+        for parts in group:
+            if not parts:
+                pages[parts] = "index.html"
+            elif len(group) == 1:
+                pages[parts] = f"index_{name}.html"
+            else:
+                digest = hashlib.sha256("/".join(parts).encode()).hexdigest()[:8]
+                pages[parts] = f"index_{name}_{digest}.html"
+    return pages
 
-        for key, d in cov_data.items():
-            gdict[str(base)][key].append(d)
 
-    return OrderedDict(sorted(gdict.items()))
+def breadcrumbs(parts, pages):
+    """Path segments (name, href) of the page of `parts`, ancestors link to their pages."""
+    return [(part, pages[parts[: i + 1]]) for i, part in enumerate(parts[:-1])] + [
+        (part, None) for part in parts[-1:]
+    ]
 
 
-def generate_file_dict(file_cov_map, base: Path, code_root_path: Path):
-    """Process coverage data grouped by file."""
-    gdict = defaultdict(lambda: defaultdict(list))
+def page_digest(*inputs):
+    """Digest of everything a page is rendered from, except for the generation time."""
+    content = json.dumps([template_version(), *inputs], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode()).hexdigest()
 
-    for file, cov_data in dict(file_cov_map).items():
-        if file == "Total:":
-            continue
-        if Path(file).resolve().parent.relative_to(code_root_path) == base:
-            for key, data in cov_data.items():
-                gdict[Path(file).name][key] = data
 
-                if len(gdict["Total:"][key]) == 0:
-                    gdict["Total:"][key] = [0, 0]
+def load_report_manifest(manifest_path):
+    """Loads digests of the pages rendered by a previous run.
+    Returns an empty manifest if it is malformed. Without a manifest, pages found in the
+    directory (e.g. named under an earlier naming scheme) are recorded with unknown digests,
+    so that the ones which are no longer produced are removed."""
+    manifest_path = Path(manifest_path)
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)["pages"]
+    except FileNotFoundError:
+        return {page.name: None for page in manifest_path.parent.glob("index_*.html")}
+    except (OSError, ValueError, KeyError):
+        return {}
 
-                gdict["Total:"][key][0] += data[0]
-                gdict["Total:"][key][1] += data[1]
 
-    return gdict
+def save_report_manifest(manifest_path, pages):
+    """Stores digests of the rendered pages. The manifest is replaced rather than
+    written to, as dashboards may be hardlinked into the webpage."""
+    with atomic_write(manifest_path) as f:
+        json.dump({"pages": pages}, f, indent=1, sort_keys=True)
+
+
+def is_page_current(recorded, produced, output_dir, page):
+    """Checks whether the page rendered by a previous run is still up to date."""
+    if recorded.get(page) == produced[page] and (Path(output_dir) / page).exists():
+        logger.debug(f"Up to date: {page}")
+        return True
+    return False
+
+
+def prune_pages(recorded, pages, output_dir):
+    """Removes pages rendered by a previous run which are no longer produced."""
+    for page in sorted(recorded.keys() - pages.keys()):
+        page_path = Path(output_dir) / page
+        if page_path.exists():
+            logger.debug(f"Removing stale {page_path}")
+            page_path.unlink()
 
 
 def unify_dict(data):
     """Adds 0-entries for tests with non reported coverage."""
     # Figure out the list of all tests:
-    tests = {k for cov_data in data.values() for k in cov_data.keys()}
+    tests = sorted({k for cov_data in data.values() for k in cov_data.keys()})
 
     # Add missing ones to the dict:
     for cov_data in data.values():
@@ -307,87 +402,126 @@ def genhtml(
     src_path,
     output_dir,
     test_name,
-    html_src_dir,
     project_name="Project",
     logo_src=None,
     logo_href=None,
+    *,
+    timestamp=None,
+    stylesheet="cov.css",
+    table_mode="html",
+    table_script=None,
 ):
-    """Generates coverage dashboard from *.info files."""
+    """Generates coverage dashboard from *.info files.
+    Pages are stamped with `timestamp`, the current time if not given,
+    and styled with `stylesheet` (relative to the output directory).
+    With the json `table_mode`, tables are rendered in the browser by `table_script`."""
 
     if not Path(output_dir).is_dir():
         msg = f"Output directory '{output_dir}' does not exist."
         raise FileNotFoundError(msg)
 
-    data = parse_infos(input_files)
+    tracefiles = {file: tracefile_cache.load(file) for file in input_files}
+    data = summarize_tracefiles(tracefiles)
 
     # The LCOV must be ran with '--list-full-path' so that the paths to sources
     # are not 'simplified' with '...'.
-    code_root_path = Path(src_path).resolve().parent
+    code_root_path = resolve_path(src_path).parent
 
     data = unify_dict(data)
-    tld = generate_dir_dict(data, code_root_path)
-
-    template_env = Environment(loader=FileSystemLoader(coverage_dashboard_template_dir))
-
-    for file in list(data.keys()):
-        if file == "Total:":
+    tree = build_dir_tree(data, code_root_path)
+
+    # The landing page starts at the first directory with more than one entry
+    top = collapsed_root(tree)
+    if top:
+        code_root_path = code_root_path.joinpath(*top)
+        tree = build_dir_tree(data, code_root_path)
+    files = {
+        file: relative_parts(file, code_root_path)
+        for node in tree.values()
+        for file in node["files"]
+    }
+    pages = assign_page_names([*tree, *files.values()])
+
+    # Pages whose inputs didn't change since the previous run are kept as they are
+    manifest_path = Path(output_dir) / REPORT_MANIFEST_NAME
+    recorded = load_report_manifest(manifest_path)
+    produced = {}
+    page_args = [
+        test_name,
+        project_name,
+        logo_src,
+        logo_href,
+        stylesheet,
+        table_mode,
+        table_script,
+        code_root_path.name,
+    ]
+    time_token = (timestamp or datetime.datetime.now()).strftime("%d-%m-%Y %H:%M:%S")
+
+    for key, node in tree.items():
+        rows, hrefs = {}, {}
+
+        for child in sorted(node["dirs"]):
+            rows[child[-1]] = tree[child]["Total:"]
+            hrefs[child[-1]] = pages[child]
+
+        for file, cov_data in sorted(node["files"].items()):
+            parts = files[file]
+            rows[parts[-1]] = cov_data
+            hrefs[parts[-1]] = pages[parts]
+
+            src_file = resolve_path(file)
+            line_hits = combine_line_hits(tracefiles.values(), file)
+            if src_file.is_file():
+                produced[pages[parts]] = page_digest(
+                    page_args,
+                    breadcrumbs(parts, pages),
+                    cov_data,
+                    sorted(line_hits.items()),
+                    file_digest(src_file),
+                )
+                if is_page_current(recorded, produced, output_dir, pages[parts]):
+                    continue
+
+            sub_src_view(
+                data=cov_data,
+                file=file,
+                test_name=test_name,
+                root_name=code_root_path.name,
+                path_segments=breadcrumbs(parts, pages),
+                out_dir=f"{output_dir}/{pages[parts]}",
+                line_hits=line_hits,
+                logo_src=logo_src,
+                logo_href=logo_href,
+                project_name=project_name,
+                time_token=time_token,
+                stylesheet=stylesheet,
+            )
+
+        rows["Total:"] = data["Total:"] if not key else node["Total:"]
+        outputs = [pages[key]]
+        if table_mode == "json":
+            outputs.append(table_data_name(pages[key]))
+        for page in outputs:
+            produced[page] = page_digest(page_args, breadcrumbs(key, pages), rows, hrefs)
+        if all(is_page_current(recorded, produced, output_dir, page) for page in outputs):
             continue
 
-        file_path = Path(file).resolve()
-        segments = str(file_path.relative_to(code_root_path)).split("/")
-
-        sub_src_view(
-            data=data[file],
-            file=file,
-            test_name=test_name,
-            root_name=code_root_path.name,
-            path_segments=segments,
-            src_prefix=Path(src_path).resolve(),
-            out_dir=f"{output_dir}/index_{Path(file).name}.html",
-            html_src_dir=html_src_dir,
-            logo_src=logo_src,
-            logo_href=logo_href,
-            project_name=project_name,
-            template_env=template_env,
-        )
-
-    for key in list(tld.keys()):
-        if key == "Total:":
-            continue
-        subdata = generate_file_dict(data, Path(key), code_root_path)
         render_page(
-            data=subdata,
+            data=rows,
             root_name=code_root_path.name,
-            path_segments=key.split("/"),
-            out_dir=f"{output_dir}/index_{key.replace('/','_')}.html",
+            path_segments=breadcrumbs(key, pages),
+            out_dir=f"{output_dir}/{pages[key]}",
             test_name=test_name,
             logo_src=logo_src,
             logo_href=logo_href,
             project_name=project_name,
-            template_env=template_env,
+            hrefs=hrefs,
+            time_token=time_token,
+            stylesheet=stylesheet,
+            table_mode=table_mode,
+            table_script=table_script,
         )
 
-    for file, cov_data in tld.items():
-        if file == "Total:":
-            continue
-        for test_type, dat in cov_data.items():
-            hit, total = 0, 0
-            for measurement in dat:
-                hit += measurement[0]
-                total += measurement[1]
-            if total > 0:
-                cov_data[test_type] = [hit, total]
-            else:
-                cov_data[test_type] = [0, 0]
-    render_page(
-        data=tld,
-        root_name=code_root_path.name,
-        path_segments=["src"],
-        out_dir=f"{output_dir}/index.html",
-        test_name=test_name,
-        logo_src=logo_src,
-        logo_href=logo_href,
-        template_env=template_env,
-        project_name=project_name,
-        links=True,
-    )
+    prune_pages(recorded, produced, output_dir)
+    save_report_manifest(manifest_path, produced)
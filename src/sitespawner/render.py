@@ -0,0 +1,75 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import hashlib
+from functools import lru_cache
+from pathlib import Path
+
+from jinja2 import Environment, FileSystemBytecodeCache, FileSystemLoader
+
+from sitespawner.common import (
+    atomic_write,
+    coverage_dashboard_template_dir,
+    template_dir,
+    webpage_template_dir,
+)
+
+# Size of the chunks rendered pages are written to disk in
+STREAM_BUFFER_SIZE = 1 << 16
+
+# Rendering environment shared by the coverage dashboard and webpage generation.
+# Templates are compiled once per process, their bytecode is cached between runs.
+template_env = Environment(
+    loader=FileSystemLoader(
+        [coverage_dashboard_template_dir, webpage_template_dir, template_dir],
+    ),
+    bytecode_cache=FileSystemBytecodeCache(),
+    auto_reload=False,
+)
+
+
+def set_bytecode_cache_dir(cache_dir):
+    """Stores compiled templates in `cache_dir` instead of the system temporary directory."""
+    bytecode_dir = Path(cache_dir) / "jinja"
+    bytecode_dir.mkdir(parents=True, exist_ok=True)
+    template_env.bytecode_cache = FileSystemBytecodeCache(str(bytecode_dir))
+
+
+@lru_cache(maxsize=None)
+def template_version():
+    """Digest of all templates, changes whenever any of them is modified."""
+    digest = hashlib.sha256()
+    for name in template_env.list_templates(filter_func=lambda n: "__pycache__" not in n):
+        source, _, _ = template_env.loader.get_source(template_env, name)
+        digest.update(name.encode())
+        digest.update(source.encode())
+    return digest.hexdigest()
+
+
+def render_to_file(name, path, context, trailing_newline=True):
+    """Streams the template rendered with `context` into `path`, so that the page is never
+    held in memory as a whole. The page replaces `path` atomically once complete."""
+    with atomic_write(path, buffering=STREAM_BUFFER_SIZE) as f:
+        stream = template_env.get_template(name).stream(**context)
+        stream.enable_buffering(size=64)
+        stream.dump(f)
+        if trailing_newline:
+            f.write("\n")
+
+
+def render_if_changed(name, path, context, trailing_newline=True):
+    """Renders the template into `path` only if the result differs from the file's contents,
+    so that its modification time reflects the last actual change. Returns True if written."""
+    content = template_env.get_template(name).render(**context)
+    if trailing_newline:
+        content += "\n"
+    path = Path(path)
+    try:
+        if path.read_text() == content:
+            return False
+    except FileNotFoundError:
+        pass
+    with atomic_write(path) as f:
+        f.write(content)
+    return True
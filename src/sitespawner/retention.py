@@ -0,0 +1,113 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+import re
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from shutil import rmtree
+
+from sitespawner.common import args_on_debug_logger, atomic_write, get_logger, main_func_log
+
+logger = get_logger(__name__)
+
+# Times of the last deployment of each webpage directory, kept in the root of the webpage
+DEPLOYMENTS_STATE_NAME = ".sis_deployments.json"
+# Directories subject to the retention policy, `main` is always kept
+RETAINED_DIR = "dev"
+
+
+def load_deployments(state_path):
+    """Reads deploy times of webpage directories, an empty dict if there are none yet."""
+    try:
+        with open(state_path) as f:
+            deployments = json.load(f)["deployments"]
+    except FileNotFoundError:
+        return {}
+    except (ValueError, KeyError):
+        logger.warning(f"Ignoring malformed deployment state: {state_path}")
+        return {}
+    return {name: datetime.fromisoformat(time) for name, time in deployments.items()}
+
+
+def save_deployments(state_path, deployments):
+    """Stores deploy times of webpage directories."""
+    deployments = {name: time.isoformat(timespec="seconds") for name, time in deployments.items()}
+    with atomic_write(state_path) as f:
+        json.dump({"deployments": deployments}, f, indent=1, sort_keys=True)
+
+
+def natural_key(name):
+    """Sort key ordering numbers within names by value, e.g. `dev/9` before `dev/10`."""
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", name)]
+
+
+def select_evicted(deployments, kept, now, retain_last=None, retain_days=None):
+    """Lists directories outside the retention policy: all but `retain_last` most recently
+    deployed ones and the ones not deployed within `retain_days`. Directories in `kept`
+    are never evicted, but take up retained slots. Directories deployed at the same time
+    are ordered by name, higher numbers (e.g. newer pull requests) counting as more recent.
+    Returns a list of (name, deploy time) tuples, oldest first."""
+    candidates = sorted(
+        ((name, time) for name, time in deployments.items() if name not in kept),
+        key=lambda entry: (entry[1], natural_key(entry[0])),
+        reverse=True,
+    )
+    evicted = set()
+    if retain_last is not None:
+        keep = max(retain_last - len(kept & deployments.keys()), 0)
+        evicted.update(name for name, _ in candidates[keep:])
+    if retain_days is not None:
+        cutoff = now - timedelta(days=retain_days)
+        evicted.update(name for name, time in candidates if time < cutoff)
+    return [(name, time) for name, time in reversed(candidates) if name in evicted]
+
+
+@main_func_log(logger, "Apply retention policy")
+@args_on_debug_logger(logger)
+def apply_retention(page_dir, current, retain_last=None, retain_days=None, dry_run=False):
+    """Records the deployment of the `current` directory (e.g. `dev/123`) of the webpage
+    in `page_dir` and removes `dev` directories which fall outside the retention policy.
+    Directories without a recorded deployment (e.g. deployed before the state was kept)
+    are recorded with their modification time and only become subject to the policy
+    in subsequent runs. With `dry_run`, directories which would be evicted are only listed."""
+    page_dir = Path(page_dir)
+    html_dir = page_dir / "html"
+    state_path = page_dir / DEPLOYMENTS_STATE_NAME
+    now = datetime.now(timezone.utc)
+
+    recorded = load_deployments(state_path)
+    retained_dir = html_dir / RETAINED_DIR
+    deployments = {}
+    kept = {current}
+    for path in sorted(retained_dir.glob("*")):
+        if not path.is_dir():
+            continue
+        name = f"{RETAINED_DIR}/{path.name}"
+        if name in recorded:
+            deployments[name] = recorded[name]
+            continue
+        mtime = datetime.fromtimestamp(path.stat().st_mtime, tz=timezone.utc)
+        deployments[name] = min(mtime, now)
+        kept.add(name)
+    if current.startswith(f"{RETAINED_DIR}/"):
+        deployments[current] = now
+
+    evicted = select_evicted(deployments, kept, now, retain_last, retain_days)
+    for name, time in evicted:
+        age = (now - time).days
+        if dry_run:
+            logger.info(f"Would evict {name} (last deployed {time:%Y-%m-%d}, {age} days ago)")
+            continue
+        logger.info(f"Evicting {name} (last deployed {time:%Y-%m-%d}, {age} days ago)")
+        rmtree(html_dir / name)
+        del deployments[name]
+
+    if not evicted:
+        logger.info(f"No directories to evict out of {len(deployments)}")
+    elif dry_run:
+        logger.info(f"Dry run, {len(evicted)} of {len(deployments)} directories would be evicted")
+
+    save_deployments(state_path, deployments)
+    return [name for name, _ in evicted]
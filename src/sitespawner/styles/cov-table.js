@@ -0,0 +1,220 @@
+// Copyright (c) 2024 Antmicro <www.antmicro.com>
+//
+// SPDX-License-Identifier: Apache-2.0
+
+// Renders coverage tables of dashboards generated with `--table-mode json`.
+// Rows are loaded from the page's JSON payload and only the rows within
+// the scrolled viewport are present in the document.
+(function () {
+  "use strict";
+
+  const ROW_HEIGHT = 44;
+  const OVERSCAN = 10;
+  const GRADIENT = [
+    [0xef, 0x44, 0x44],
+    [0xf9, 0x73, 0x16],
+    [0xea, 0xb3, 0x08],
+    [0x84, 0xcc, 0x16],
+    [0x16, 0xa3, 0x4a],
+  ];
+
+  function rate(hit, total) {
+    return total ? (hit / total) * 100 : 0;
+  }
+
+  // Same gradient as `get_color` of genhtml.py
+  function color(percentage) {
+    const segment = 100 / (GRADIENT.length - 1);
+    const index = Math.min(Math.floor(percentage / segment), GRADIENT.length - 2);
+    const frac = (percentage - index * segment) / segment;
+    const rgb = GRADIENT[index].map((start, i) => {
+      const value = Math.round(start + (GRADIENT[index + 1][i] - start) * frac);
+      return Math.max(0, Math.min(255, value));
+    });
+    return "#" + rgb.map((c) => c.toString(16).padStart(2, "0")).join("");
+  }
+
+  function capitalize(text) {
+    return text.charAt(0).toUpperCase() + text.slice(1).toLowerCase();
+  }
+
+  function cell(row, text, className) {
+    const td = row.insertCell();
+    if (text !== undefined) {
+      td.textContent = text;
+    }
+    if (className) {
+      td.className = className;
+    }
+    return td;
+  }
+
+  function colgroup(types) {
+    const group = document.createElement("colgroup");
+    const add = (width) => {
+      const col = document.createElement("col");
+      col.style.width = width + "%";
+      group.appendChild(col);
+    };
+    add(20);
+    const container = 80 / types.length;
+    types.forEach(() => {
+      add(container * 0.5);
+      add(container * 0.25);
+      add(container * 0.25);
+    });
+    return group;
+  }
+
+  function render(root, data) {
+    const types = data.types;
+    const rows = data.names.map((name, i) => ({
+      name: name,
+      href: data.hrefs[i],
+      hit: types.map((type) => data.hit[type][i]),
+      total: types.map((type) => data.total[type][i]),
+    }));
+    let view = rows;
+    let sortKey = null;
+    let descending = false;
+
+    const filter = document.createElement("input");
+    filter.type = "search";
+    filter.placeholder = "Filter sources";
+    filter.className = "covFilter";
+
+    const header = document.createElement("table");
+    header.className = "covTable";
+    header.appendChild(colgroup(types));
+
+    const typeRow = header.insertRow();
+    typeRow.className = "covDescHeader";
+    cell(typeRow);
+    types.forEach((type) => {
+      cell(typeRow, capitalize(type), "headerCovDesc").colSpan = 3;
+    });
+
+    const descRow = header.insertRow();
+    descRow.className = "covDescHeader";
+    const sortable = (text, key, span) => {
+      const td = cell(descRow, text, "headerCovSubDesc covSortable");
+      td.colSpan = span;
+      td.title = "Sort";
+      td.addEventListener("click", () => {
+        descending = sortKey === key ? !descending : key !== "name";
+        sortKey = key;
+        update();
+      });
+    };
+    sortable("Source", "name", 1);
+    types.forEach((_, i) => {
+      sortable("Rate", "rate" + i, 2);
+      sortable("Hit / Total", "total" + i, 1);
+    });
+
+    const viewport = document.createElement("div");
+    viewport.className = "covViewport";
+    const spacer = document.createElement("div");
+    spacer.className = "covSpacer";
+    const body = document.createElement("table");
+    body.className = "covTable covBody";
+    body.appendChild(colgroup(types));
+    const tbody = body.createTBody();
+    spacer.appendChild(body);
+    viewport.appendChild(spacer);
+
+    function rowElement(row) {
+      const tr = document.createElement("tr");
+      tr.className = "covRow";
+      const name = cell(tr);
+      if (row.href) {
+        const a = document.createElement("a");
+        a.href = row.href;
+        a.textContent = row.name;
+        name.appendChild(a);
+      } else {
+        name.textContent = row.name;
+      }
+      types.forEach((_, i) => {
+        const frac = rate(row.hit[i], row.total[i]);
+        const barColor = color(frac);
+
+        const container = document.createElement("div");
+        container.className = "container";
+        const bar = document.createElement("div");
+        bar.className = "covBar";
+        bar.style.backgroundColor = barColor;
+        bar.style.width = Math.max(frac, 5) + "%";
+        container.appendChild(bar);
+        cell(tr).appendChild(container);
+
+        const rateCell = cell(tr, row.hit[i] === 0 ? "——" : frac.toFixed(1) + "%");
+        rateCell.style.color = barColor;
+        cell(tr, row.hit[i] + " / " + row.total[i]);
+      });
+      return tr;
+    }
+
+    function draw() {
+      spacer.style.height = view.length * ROW_HEIGHT + "px";
+      const top = viewport.scrollTop;
+      const first = Math.max(0, Math.floor(top / ROW_HEIGHT) - OVERSCAN);
+      const last = Math.min(
+        view.length,
+        Math.ceil((top + viewport.clientHeight) / ROW_HEIGHT) + OVERSCAN
+      );
+      body.style.transform = "translateY(" + first * ROW_HEIGHT + "px)";
+      tbody.replaceChildren(...view.slice(first, last).map(rowElement));
+    }
+
+    function compare(a, b) {
+      if (sortKey === "name") {
+        return a.name.localeCompare(b.name);
+      }
+      const i = Number(sortKey.slice(sortKey.search(/\d/)));
+      if (sortKey.startsWith("rate")) {
+        return rate(a.hit[i], a.total[i]) - rate(b.hit[i], b.total[i]);
+      }
+      return a.total[i] - b.total[i];
+    }
+
+    function update() {
+      const query = filter.value.trim().toLowerCase();
+      view = query ? rows.filter((row) => row.name.toLowerCase().includes(query)) : rows.slice();
+      if (sortKey !== null) {
+        view.sort((a, b) => (descending ? compare(b, a) : compare(a, b)));
+      }
+      viewport.scrollTop = 0;
+      draw();
+    }
+
+    let pending = false;
+    viewport.addEventListener("scroll", () => {
+      if (!pending) {
+        pending = true;
+        requestAnimationFrame(() => {
+          pending = false;
+          draw();
+        });
+      }
+    });
+    filter.addEventListener("input", update);
+
+    root.replaceChildren(filter, header, viewport);
+    draw();
+  }
+
+  document.querySelectorAll("[data-cov-table]").forEach((root) => {
+    fetch(root.dataset.covTable)
+      .then((response) => {
+        if (!response.ok) {
+          throw new Error(response.status + " " + response.statusText);
+        }
+        return response.json();
+      })
+      .then((data) => render(root, data))
+      .catch((error) => {
+        root.textContent = "Failed to load coverage data: " + error.message;
+      });
+  });
+})();
@@ -0,0 +1,495 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import heapq
+import marshal
+import os
+import re
+import tempfile
+from array import array
+from collections import OrderedDict
+from copy import copy
+from itertools import groupby
+from operator import itemgetter
+from pathlib import Path
+from sys import intern
+
+from sitespawner.common import file_digest
+
+# Taken count of a branch which was never evaluated ('-' in BRDA records)
+NOT_TAKEN = -1
+
+# Source paths may contain arbitrary bytes, preserve them as they are
+TRACEFILE_ENCODING = {"encoding": "utf-8", "errors": "surrogateescape"}
+
+# Default number of tracefiles merged at once, larger sets are merged through spill files
+DEFAULT_MERGE_FAN_IN = 64
+
+# Version of the on-disk cache format, bump when FileCoverage layout changes
+CACHE_FORMAT_VERSION = 1
+
+# Default size limit of the on-disk cache of parsed tracefiles, in MiB
+DEFAULT_CACHE_SIZE = 1024
+
+# Default limit of line, branch and function entries of tracefiles kept in memory (~256 MiB),
+# worker processes forked by report generation inherit the memory of the parent
+DEFAULT_MEMO_ENTRIES = 1 << 24
+
+
+def add_taken(a, b):
+    """Sums branch taken counts, keeping NOT_TAKEN only if neither branch was evaluated."""
+    if a == NOT_TAKEN:
+        return b
+    if b == NOT_TAKEN:
+        return a
+    return a + b
+
+
+def compile_pattern(pattern):
+    """Compiles a shell wildcard pattern (`*`, `?`) into a regex matching whole paths,
+    the same way lcov does for `--extract` and `--remove`."""
+    regex = re.escape(pattern).replace(r"\*", ".*").replace(r"\?", ".")
+    return re.compile(f"^{regex}$")
+
+
+class FileCoverage:
+    """Coverage data of a single source file, i.e. an `SF:` record of an LCOV tracefile.
+
+    Line, branch and function data is kept in flat arrays sorted by line number."""
+
+    __slots__ = (
+        "branch_ids",
+        "branch_lines",
+        "branch_taken",
+        "function_hits",
+        "function_lines",
+        "function_names",
+        "line_hits",
+        "lines",
+        "path",
+    )
+
+    def __init__(self, path, lines=None, branches=None, functions=None):
+        """`lines` maps line numbers to hit counts, `branches` maps (line, "block,branch")
+        pairs to taken counts and `functions` maps function names to (line, hit count) pairs."""
+        self.path = path
+        self.set_data(lines or {}, branches or {}, functions or {})
+
+    def set_data(self, lines, branches, functions):
+        """Replaces coverage data with the contents of the given dicts."""
+        self.lines = array("l", sorted(lines))
+        self.line_hits = array("q", (lines[line] for line in self.lines))
+
+        # Branches keep their order within a line, as lcov does
+        keys = sorted(branches, key=itemgetter(0))
+        self.branch_lines = array("l", (line for line, _ in keys))
+        self.branch_ids = [branch for _, branch in keys]
+        self.branch_taken = array("q", (branches[key] for key in keys))
+
+        names = sorted(functions, key=lambda name: functions[name][0])
+        self.function_names = names
+        self.function_lines = array("l", (functions[name][0] for name in names))
+        self.function_hits = array("q", (functions[name][1] for name in names))
+
+    def line_dict(self):
+        return dict(zip(self.lines, self.line_hits))
+
+    def branch_dict(self):
+        return dict(zip(zip(self.branch_lines, self.branch_ids), self.branch_taken))
+
+    def function_dict(self):
+        return dict(zip(self.function_names, zip(self.function_lines, self.function_hits)))
+
+    @property
+    def lines_found(self):
+        return len(self.lines)
+
+    @property
+    def lines_hit(self):
+        return sum(1 for hits in self.line_hits if hits > 0)
+
+    @property
+    def branches_found(self):
+        return len(self.branch_taken)
+
+    @property
+    def branches_hit(self):
+        return sum(1 for taken in self.branch_taken if taken > 0)
+
+    @property
+    def functions_found(self):
+        return len(self.function_names)
+
+    @property
+    def functions_hit(self):
+        return sum(1 for hits in self.function_hits if hits > 0)
+
+    def merge(self, *others):
+        """Adds hit counts of `others` records of the same source file."""
+        lines = self.line_dict()
+        branches = self.branch_dict()
+        functions = self.function_dict()
+
+        for other in others:
+            for line, hits in zip(other.lines, other.line_hits):
+                lines[line] = lines.get(line, 0) + hits
+            for key, taken in zip(zip(other.branch_lines, other.branch_ids), other.branch_taken):
+                branches[key] = add_taken(branches.get(key, NOT_TAKEN), taken)
+            for name, line, hits in zip(
+                other.function_names, other.function_lines, other.function_hits
+            ):
+                old_line, old_hits = functions.get(name, (line, 0))
+                functions[name] = (old_line, old_hits + hits)
+
+        self.set_data(lines, branches, functions)
+        return self
+
+    def to_tuple(self):
+        """Flattens the record into a tuple of builtin types, used for caching."""
+        return (
+            self.path,
+            self.lines.tobytes(),
+            self.line_hits.tobytes(),
+            self.branch_lines.tobytes(),
+            tuple(self.branch_ids),
+            self.branch_taken.tobytes(),
+            tuple(self.function_names),
+            self.function_lines.tobytes(),
+            self.function_hits.tobytes(),
+        )
+
+    @classmethod
+    def from_tuple(cls, data):
+        """Restores a record flattened with `to_tuple`."""
+        record = cls.__new__(cls)
+        record.path = data[0]
+        record.lines = array("l", data[1])
+        record.line_hits = array("q", data[2])
+        record.branch_lines = array("l", data[3])
+        record.branch_ids = [intern(branch) for branch in data[4]]
+        record.branch_taken = array("q", data[5])
+        record.function_names = list(data[6])
+        record.function_lines = array("l", data[7])
+        record.function_hits = array("q", data[8])
+        return record
+
+    def to_lcov(self, test_name=""):
+        """Formats the record the same way lcov writes its tracefiles. Unlike lcov with its
+        default settings (branch coverage disabled), branch records are kept. Function
+        summaries are only written for records with functions, as lcov's outputs had none."""
+        out = [f"TN:{test_name}\n", f"SF:{self.path}\n"]
+
+        for name, line in zip(self.function_names, self.function_lines):
+            out.append(f"FN:{line},{name}\n")
+        for name, hits in zip(self.function_names, self.function_hits):
+            out.append(f"FNDA:{hits},{name}\n")
+        if self.function_names:
+            out.append(f"FNF:{self.functions_found}\nFNH:{self.functions_hit}\n")
+
+        for line, branch, taken in zip(self.branch_lines, self.branch_ids, self.branch_taken):
+            out.append(f"BRDA:{line},{branch},{'-' if taken == NOT_TAKEN else taken}\n")
+        if self.branch_taken:
+            out.append(f"BRF:{self.branches_found}\nBRH:{self.branches_hit}\n")
+
+        out.extend(f"DA:{line},{hits}\n" for line, hits in zip(self.lines, self.line_hits))
+        out.append(f"LF:{self.lines_found}\nLH:{self.lines_hit}\nend_of_record\n")
+        return "".join(out)
+
+
+def iter_records(path):
+    """Streams (test name, FileCoverage) records of an LCOV tracefile in order of appearance.
+
+    Summary entries (LF, LH, BRF, ...) are not read, they are computed from the data.
+    Repeated DA/BRDA entries within a record are summed."""
+    test_name = ""
+    source = None
+    lines, branches, functions = {}, {}, {}
+    with open(path, **TRACEFILE_ENCODING) as f:
+        for entry in f:
+            tag, _, value = entry.rstrip("\n").partition(":")
+            if tag == "DA":
+                line, hits = value.split(",", 2)[:2]
+                line = int(line)
+                lines[line] = lines.get(line, 0) + int(hits)
+            elif tag == "BRDA":
+                line, block, rest = value.split(",", 2)
+                branch, taken = rest.rsplit(",", 1)
+                key = (int(line), intern(f"{block},{branch}"))
+                taken = NOT_TAKEN if taken == "-" else int(taken)
+                branches[key] = add_taken(branches.get(key, NOT_TAKEN), taken)
+            elif tag == "SF":
+                source = value
+                lines, branches, functions = {}, {}, {}
+            elif tag == "FN":
+                line, name = value.split(",", 1)
+                functions[name] = (int(line), functions.get(name, (0, 0))[1])
+            elif tag == "FNDA":
+                hits, name = value.split(",", 1)
+                line, old_hits = functions.get(name, (0, 0))
+                functions[name] = (line, old_hits + int(hits))
+            elif tag == "TN":
+                test_name = value
+            elif tag == "end_of_record":
+                if source is not None:
+                    yield test_name, FileCoverage(source, lines, branches, functions)
+                source = None
+
+
+class Tracefile:
+    """In-memory LCOV tracefile: coverage records of source files keyed by their paths."""
+
+    __slots__ = ("files", "test_name")
+
+    def __init__(self, test_name="", files=None):
+        self.test_name = test_name
+        self.files = files if files is not None else {}
+
+    @classmethod
+    def read(cls, path):
+        """Parses the tracefile at `path`."""
+        if not Path(path).is_file():
+            msg = f"Input file '{path}' does not exist."
+            raise FileNotFoundError(msg)
+
+        tracefile = cls()
+        for test_name, record in iter_records(path):
+            tracefile.test_name = tracefile.test_name or test_name
+            tracefile.add(record)
+        return tracefile
+
+    def add(self, record):
+        """Adds a source file record, merging it with an existing one for the same file."""
+        if record.path in self.files:
+            self.files[record.path].merge(record)
+        else:
+            self.files[record.path] = record
+
+    def filter(self, include=None, exclude=None, substitute=None):
+        """Filters source file records in a single pass, equivalent to `lcov --extract <include...>`
+        with `--substitute s|old|new|` followed by `lcov --remove <exclude...>`.
+
+        `substitute` is an (old, new) pair replacing the first occurrence of `old` in source paths.
+        Records are kept if they match any of `include` patterns and none of `exclude` ones.
+        Returns a new tracefile, this one is left unchanged."""
+        include = [compile_pattern(p) for p in include or []]
+        exclude = [compile_pattern(p) for p in exclude or []]
+
+        filtered = Tracefile(self.test_name)
+        for original in self.files.values():
+            record = copy(original)
+            if substitute:
+                record.path = record.path.replace(substitute[0], substitute[1], 1)
+            if include and not any(p.match(record.path) for p in include):
+                continue
+            if any(p.match(record.path) for p in exclude):
+                continue
+            filtered.add(record)
+        return filtered
+
+    @property
+    def entries(self):
+        """Number of line, branch and function entries, a measure of the memory held."""
+        return sum(
+            len(record.lines) + len(record.branch_ids) + len(record.function_names)
+            for record in self.files.values()
+        )
+
+    @property
+    def lines_found(self):
+        return sum(record.lines_found for record in self.files.values())
+
+    @property
+    def lines_hit(self):
+        return sum(record.lines_hit for record in self.files.values())
+
+    def write(self, path):
+        """Writes the tracefile in lcov's format, with records sorted by source path."""
+        with open(path, "w", **TRACEFILE_ENCODING) as f:
+            for source in sorted(self.files):
+                f.write(self.files[source].to_lcov(self.test_name))
+
+    def dumps(self):
+        """Serializes the tracefile into a compact binary form."""
+        records = tuple(record.to_tuple() for record in self.files.values())
+        return marshal.dumps((CACHE_FORMAT_VERSION, self.test_name, records))
+
+    @classmethod
+    def loads(cls, data):
+        """Restores a tracefile serialized with `dumps`."""
+        version, test_name, records = marshal.loads(data)  # noqa: S302
+        if version != CACHE_FORMAT_VERSION:
+            msg = f"Unsupported cache format version: {version}"
+            raise ValueError(msg)
+        tracefile = cls(test_name)
+        for record_data in records:
+            record = FileCoverage.from_tuple(record_data)
+            tracefile.files[record.path] = record
+        return tracefile
+
+
+def is_sorted_tracefile(path):
+    """Checks whether records of the tracefile are ordered by source path."""
+    last = None
+    with open(path, **TRACEFILE_ENCODING) as f:
+        for entry in f:
+            if entry.startswith("SF:"):
+                source = entry[3:].rstrip("\n")
+                if last is not None and source < last:
+                    return False
+                last = source
+    return True
+
+
+def iter_sorted_records(path, spill_dir):
+    """Streams records of the tracefile ordered by source path.
+    Unsorted tracefiles are sorted once into a spill file in `spill_dir`."""
+    if not is_sorted_tracefile(path):
+        spill = tempfile.NamedTemporaryFile(dir=spill_dir, suffix=".info", delete=False)
+        spill.close()
+        Tracefile.read(path).write(spill.name)
+        path = spill.name
+    yield from iter_records(path)
+
+
+def merge_sorted(input_files, output_file, spill_dir):
+    """k-way merge of tracefiles, only one record per input is kept in memory."""
+    streams = [iter_sorted_records(path, spill_dir) for path in input_files]
+    merged = heapq.merge(*streams, key=lambda item: item[1].path)
+
+    with open(output_file, "w", **TRACEFILE_ENCODING) as f:
+        for _, group in groupby(merged, key=lambda item: item[1].path):
+            (test_name, record), *others = group
+            if others:
+                record.merge(*(other for _, other in others))
+            f.write(record.to_lcov(test_name))
+
+
+def merge_tracefiles(input_files, output_file, fan_in=DEFAULT_MERGE_FAN_IN, spill_dir=None):
+    """Merges tracefiles into `output_file`, summing hit counts per source file.
+    The equivalent of `lcov -a <input_file>... -o <output_file>`.
+
+    At most `fan_in` tracefiles are merged at once. Larger sets are merged in batches
+    into intermediate tracefiles in `spill_dir` (system temporary directory by default),
+    which are then merged together."""
+    input_files = [str(path) for path in input_files]
+    fan_in = max(fan_in, 2)
+
+    with tempfile.TemporaryDirectory(dir=spill_dir, prefix="sis-merge-") as tmp_dir:
+        level = 0
+        while len(input_files) > fan_in:
+            spilled = []
+            for start in range(0, len(input_files), fan_in):
+                spill = Path(tmp_dir) / f"merge_{level}_{start // fan_in}.info"
+                merge_sorted(input_files[start : start + fan_in], spill, tmp_dir)
+                spilled.append(str(spill))
+            input_files = spilled
+            level += 1
+
+        merge_sorted(input_files, output_file, tmp_dir)
+
+
+class TracefileCache:
+    """Cache of parsed tracefiles.
+
+    Keeps recently used tracefiles in memory, keyed by path, size and modification time,
+    up to `memo_entries` line, branch and function entries in total.
+    If `cache_dir` is set, parsed tracefiles are also stored there in a binary form,
+    keyed by the SHA-256 of the tracefile contents, so that subsequent runs over unchanged
+    inputs don't parse them again. Least recently used entries are evicted
+    once the directory grows beyond `max_size` MiB."""
+
+    def __init__(
+        self, cache_dir=None, max_size=DEFAULT_CACHE_SIZE, memo_entries=DEFAULT_MEMO_ENTRIES
+    ):
+        self.memo = OrderedDict()
+        self.memo_entries = memo_entries
+        self.memo_total = 0
+        self.configure(cache_dir, max_size)
+
+    def configure(self, cache_dir=None, max_size=DEFAULT_CACHE_SIZE):
+        """Sets the location and size limit of the on-disk cache, None disables it."""
+        self.cache_dir = Path(cache_dir) / "tracefiles" if cache_dir else None
+        self.max_size = max_size * 1024 * 1024
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def memo_key(path):
+        st = os.stat(path)
+        return (os.path.realpath(path), st.st_size, st.st_mtime_ns)
+
+    def remember(self, key, tracefile):
+        if key in self.memo:
+            self.memo_total -= self.memo.pop(key)[1]
+        entries = tracefile.entries
+        self.memo[key] = (tracefile, entries)
+        self.memo_total += entries
+        # Tracefiles bigger than the whole limit aren't kept either
+        while self.memo_total > self.memo_entries:
+            self.memo_total -= self.memo.popitem(last=False)[1][1]
+
+    def load(self, path):
+        """Returns the parsed tracefile at `path`. Returned tracefiles are shared
+        between callers and must not be modified in place."""
+        if not Path(path).is_file():
+            msg = f"Input file '{path}' does not exist."
+            raise FileNotFoundError(msg)
+
+        key = self.memo_key(path)
+        if key in self.memo:
+            self.memo.move_to_end(key)
+            return self.memo[key][0]
+
+        entry = None
+        if self.cache_dir:
+            entry = self.cache_dir / f"{file_digest(path)}.bin"
+            try:
+                tracefile = Tracefile.loads(entry.read_bytes())
+                os.utime(entry)
+                self.remember(key, tracefile)
+                return tracefile
+            except (OSError, ValueError, EOFError, TypeError):
+                pass
+
+        tracefile = Tracefile.read(path)
+        self.remember(key, tracefile)
+        if entry:
+            self.write_entry(entry, tracefile)
+        return tracefile
+
+    def store(self, path, tracefile):
+        """Records `tracefile` as the parsed contents of the file at `path`,
+        e.g. right after it was written."""
+        self.remember(self.memo_key(path), tracefile)
+        if self.cache_dir:
+            self.write_entry(self.cache_dir / f"{file_digest(path)}.bin", tracefile)
+
+    def write_entry(self, entry, tracefile):
+        tmp = entry.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_bytes(tracefile.dumps())
+        tmp.replace(entry)
+
+    def trim(self):
+        """Evicts least recently used entries from the on-disk cache until it fits in `max_size`."""
+        if not self.cache_dir:
+            return
+
+        entries = []
+        for entry in self.cache_dir.glob("*.bin"):
+            try:
+                st = entry.stat()
+            except OSError:
+                continue
+            entries.append((st.st_mtime_ns, st.st_size, entry))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            entry.unlink(missing_ok=True)
+            total -= size
+
+
+# Cache shared by all report generation stages of the current process
+tracefile_cache = TracefileCache()
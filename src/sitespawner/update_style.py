@@ -10,13 +10,6 @@ from sitespawner.common import args_on_debug_logger, get_logger, main_func_log,
 logger = get_logger(__name__)
 
 
-def copy_files(source, search_pattern, build_dir):
-    files = list(build_dir.rglob(search_pattern))
-    for file in files:
-        logger.debug(f"Copy {source} to {file}")
-        copy(source, file)
-
-
 @main_func_log(logger, "Update webpage styles")
 @args_on_debug_logger(logger)
 def update_style(build_dir):
@@ -32,6 +25,3 @@ def update_style(build_dir):
         styles_dir / "assets" / "chips-alliance-logo-mono.svg",
         build_dir / "html" / "_static" / "white.svg",
     )
-
-    chips_cov_css = styles_dir / "cov.css"
-    copy_files(chips_cov_css, chips_cov_css.name, build_dir)
@@ -2,44 +2,164 @@
 #
 # SPDX-License-Identifier: Apache-2.0
 
+import fnmatch
 import os
+import shlex
 import subprocess
+import tempfile
+import threading
 from pathlib import Path
-from shutil import copy2, copytree, rmtree
-
-from jinja2 import Environment, FileSystemLoader
+from shutil import rmtree
 
 from sitespawner.common import (
     args_on_debug_logger,
+    current_umask,
     get_logger,
+    link_or_copy,
     main_func_log,
-    template_dir,
+    reflink_or_copy,
     webpage_template_dir,
 )
+from sitespawner.compress import DEFAULT_COMPRESS_MIN_SIZE, compress_tree
 from sitespawner.generate import generate
+from sitespawner.render import render_to_file, set_bytecode_cache_dir
+from sitespawner.retention import apply_retention
 from sitespawner.update_style import update_style
 
 logger = get_logger(__name__)
 
+# Trees never modified in place after generation, their files can be shared through hardlinks.
+# Other files (e.g. Sphinx outputs) are overwritten by later steps and have to be copied.
+LINKED_TREES = {"coverage_dashboard", "docs_rendered"}
+# Directories left behind by `replace_dir` if it was interrupted, never synced
+SCRATCH_DIR_PATTERNS = (".*.new-*", ".sis-trash-*")
+
+
+def is_unchanged(src_stat, dst_path):
+    """Checks whether `dst_path` is the same file as, or a preserved copy of, the source."""
+    try:
+        dst_stat = dst_path.stat()
+    except FileNotFoundError:
+        return False
+    if (dst_stat.st_dev, dst_stat.st_ino) == (src_stat.st_dev, src_stat.st_ino):
+        return True
+    return (dst_stat.st_size, dst_stat.st_mtime_ns) == (src_stat.st_size, src_stat.st_mtime_ns)
+
 
 @args_on_debug_logger(logger)
-def replace_dir(src_dir, dst_dir):
-    """Removes the destination directory, creates an empty destination directory,
-    and copies contents of source directory to destination directory."""
+def sync_tree(src_dir, dst_dir, link_all=False):
+    """Brings files of `src_dir` into `dst_dir`. Files within LINKED_TREES (or all files
+    with `link_all`) are hardlinked, other ones copied (reflinked if possible),
+    files already up to date are skipped."""
+    src_dir = Path(src_dir)
+    dst_dir = Path(dst_dir)
+    stats = {action: [0, 0] for action in ("linked", "copied", "skipped")}
+
+    for root_str, dirs, files in os.walk(src_dir):
+        dirs[:] = sorted(
+            d for d in dirs if not any(fnmatch.fnmatch(d, p) for p in SCRATCH_DIR_PATTERNS)
+        )
+        root = Path(root_str)
+        relative_path = root.relative_to(src_dir)
+        linked = link_all or not LINKED_TREES.isdisjoint(relative_path.parts)
+        dst_root = dst_dir / relative_path
+        dst_root.mkdir(parents=True, exist_ok=True)
+
+        for fname in sorted(files):
+            src_file = root / fname
+            dst_file = dst_root / fname
+            src_stat = src_file.stat()
+
+            if is_unchanged(src_stat, dst_file):
+                action = "skipped"
+            elif linked:
+                link_or_copy(src_file, dst_file)
+                action = "linked"
+            else:
+                reflink_or_copy(src_file, dst_file)
+                action = "copied"
+
+            stats[action][0] += 1
+            stats[action][1] += src_stat.st_size
+
+    summary = ", ".join(
+        f"{action} {files} files ({size / 2**20:.1f} MiB)"
+        for action, (files, size) in stats.items()
+    )
+    logger.info(f"Synced {src_dir} to {dst_dir}: {summary}")
+    return stats
+
+
+@args_on_debug_logger(logger)
+def replace_dir(src_dir, dst_dir, work_dir=None):
+    """Replaces the destination directory with the contents of the source directory.
+    The new tree is staged in `work_dir` (the destination's parent by default) with hardlinks
+    to the source files and swapped in with renames, so the destination is never partially
+    written. `work_dir` has to be on the same filesystem as the destination and should be
+    outside of any tree which gets published. The previous tree is moved into `work_dir`
+    and removed in a background thread, which is returned to be joined."""
     src_path = Path(src_dir)
     dst_path = Path(dst_dir)
 
     if not src_path.is_dir():
         return logger.warning("Source directory not present!")
 
-    # Replace existing pages with new ones
-    if dst_path.exists():
-        rmtree(dst_path)
-    dst_path.mkdir(parents=True, exist_ok=True)
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    work_dir = work_dir or dst_path.parent
+    staging_path = Path(tempfile.mkdtemp(prefix=f".{dst_path.name}.new-", dir=work_dir))
+    try:
+        sync_tree(src_path, staging_path, link_all=True)
+        os.chmod(staging_path, 0o777 & ~current_umask())
+    except BaseException:
+        rmtree(staging_path)
+        raise
+
+    if not dst_path.exists():
+        staging_path.rename(dst_path)
+        return None
+
+    # Directories can't be renamed over non-empty ones, the old one is moved out of the way first
+    trash_path = Path(tempfile.mkdtemp(prefix=".sis-trash-", dir=work_dir))
+    dst_path.rename(trash_path / dst_path.name)
+    staging_path.rename(dst_path)
+
+    cleanup = threading.Thread(target=rmtree, args=(trash_path,), name=f"rm {trash_path}")
+    cleanup.start()
+    return cleanup
 
-    # Copy items to the new directory
-    for item in src_path.iterdir():
-        copytree(item, dst_path / item.name, dirs_exist_ok=True)
+
+@args_on_debug_logger(logger)
+def build_sphinx(source_dir, output_dir, doctree_dir, project_name, *, jobs=None, in_process=True):
+    """Builds the HTML pages with Sphinx. Sphinx runs in the current process, unless
+    `in_process` is False or the SPHINXBUILD environment variable points to another
+    executable. Additional options are taken from the SPHINXOPTS environment variable."""
+    # Outputs carried over from the previous webpage are up to date unless their sources changed
+    sphinx_args = [
+        "-b",
+        "html",
+        "-d",
+        str(doctree_dir),
+        "-j",
+        str(jobs or "auto"),
+        "-D",
+        f"project={project_name}",
+        *shlex.split(os.getenv("SPHINXOPTS", "")),
+        str(source_dir),
+        str(output_dir),
+    ]
+
+    sphinx_build = os.getenv("SPHINXBUILD")
+    if not in_process or sphinx_build:
+        subprocess.run([sphinx_build or "sphinx-build", *sphinx_args], check=True)
+        return
+
+    # Sphinx is only imported when building, the other commands don't need it
+    from sphinx.cmd.build import build_main  # noqa: PLC0415
+
+    status = build_main(sphinx_args)
+    if status:
+        msg = f"Sphinx build failed with status {status}"
+        raise RuntimeError(msg)
 
 
 @main_func_log(logger, "Update webpage")
@@ -51,8 +171,23 @@ def update_webpage(
     project_name,
     include_documentation,
     page_url=None,
+    *,
+    compress=False,
+    compress_min_size=DEFAULT_COMPRESS_MIN_SIZE,
+    jobs=None,
+    cache_dir=None,
+    sphinx_subprocess=False,
+    retain_last=None,
+    retain_days=None,
+    retention_dry_run=False,
 ):
-    """Updates the public part of the gh-pages based on git refs, github events, and PR numbers."""
+    """Updates the public part of the gh-pages based on git refs, github events, and PR numbers.
+    With `compress`, static files of the webpage get pre-compressed siblings.
+    With `cache_dir`, the webpage sources and the Sphinx environment are kept there between runs,
+    so that only pages affected by the changes are rebuilt.
+    Sphinx runs in-process unless `sphinx_subprocess` is set.
+    `dev` directories beyond the `retain_last` most recently deployed ones, or not deployed
+    within `retain_days` days, are removed (only listed with `retention_dry_run`)."""
     # Determine the directory based on the GitHub ref and event
     if loc_github_ref_name == "main":
         directory = "main"
@@ -65,31 +200,34 @@ def update_webpage(
         msg = "Unknown deployment type"
         raise ValueError(msg)
 
-    md_source_dir = Path("source")
     legacy_page_dir = Path("public.old")
     new_page_dir = Path("public.new")
+    if cache_dir:
+        set_bytecode_cache_dir(cache_dir)
+        md_source_dir = Path(cache_dir) / "sphinx" / "source"
+        doctree_dir = Path(cache_dir) / "sphinx" / "doctrees"
+    else:
+        md_source_dir = Path("source")
+        doctree_dir = new_page_dir / "doctrees"
 
-    replace_dir("coverage_dashboard", legacy_page_dir / "html" / directory / "coverage_dashboard")
+    # The dashboard is staged and the previous one removed in the background out of the synced tree
+    cleanup = replace_dir(
+        "coverage_dashboard",
+        legacy_page_dir / "html" / directory / "coverage_dashboard",
+        work_dir=legacy_page_dir.parent,
+    )
 
-    if md_source_dir.exists():
-        rmtree(md_source_dir)
-    else:
-        md_source_dir.mkdir(parents=True)
+    # Evicted directories aren't carried over to the new webpage
+    apply_retention(
+        legacy_page_dir,
+        directory,
+        retain_last=retain_last,
+        retain_days=retain_days,
+        dry_run=retention_dry_run,
+    )
 
     logger.info("Syncing directories...")
-
-    for root_str, dirs, files in os.walk(legacy_page_dir):
-        root = Path(root_str)
-        relative_path = root.relative_to(legacy_page_dir)
-        dst_dir = new_page_dir / relative_path
-        # Create directories in destination
-        for dir_name in dirs:
-            (dst_dir / dir_name).mkdir(parents=True, exist_ok=True)
-        # Copy files to destination
-        for fname in files:
-            src_file = root / fname
-            dst_file = dst_dir / fname
-            copy2(src_file, dst_file)
+    sync_tree(legacy_page_dir, new_page_dir)
 
     generate(
         webpage_template_dir,
@@ -98,25 +236,15 @@ def update_webpage(
         include_documentation=include_documentation,
     )
 
-    sphinx_build = os.getenv("SPHINXBUILD", "sphinx-build")
-    sphinx_opts = os.getenv("SPHINXOPTS")
-
     logger.info("Building the HTML documentation using Sphinx...")
-
-    cmd = [
-        sphinx_build,
-        "-M",
-        "html",
-        str(md_source_dir),
-        str(new_page_dir),
-        "-D",
-        f"project={project_name}",
-    ]
-
-    if sphinx_opts:
-        cmd.append(sphinx_opts)
-
-    subprocess.run(cmd, cwd=legacy_page_dir.parent, check=True)
+    build_sphinx(
+        md_source_dir,
+        new_page_dir / "html",
+        doctree_dir,
+        project_name,
+        jobs=jobs,
+        in_process=not sphinx_subprocess,
+    )
 
     update_style(new_page_dir)
 
@@ -125,8 +253,10 @@ def update_webpage(
     else:
         page_url = page_url.rstrip("/")
 
-    env = Environment(loader=FileSystemLoader(template_dir))
-    redirect = env.get_template("redirect.html").render(page_url=page_url)
+    render_to_file("redirect.html", new_page_dir / "index.html", {"page_url": page_url})
+
+    if compress:
+        compress_tree(new_page_dir, jobs=jobs, min_size=compress_min_size)
 
-    with open(new_page_dir / "index.html", "w") as f:
-        print(redirect, file=f)
+    if cleanup:
+        cleanup.join()
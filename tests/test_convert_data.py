@@ -0,0 +1,80 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import shutil
+from pathlib import Path
+
+import pytest
+
+from sitespawner.convert_data import (
+    convert_native,
+    convert_verilator,
+    merged_info_name,
+    parse_lines_range,
+)
+
+DATA_DIR = Path(__file__).parent / "data" / "convert"
+
+# Expected *.info files and the *.dat files they're converted from.
+# The expected outputs were derived by hand from the rules of `verilator_coverage --write-info`
+# (not produced by it), test_verilator_parity checks them where Verilator is installed.
+CASES = {
+    "coverage_line.info": ["coverage_line.dat"],
+    "coverage_branch.info": ["coverage_branch.dat"],
+    "coverage_toggle.info": ["coverage_toggle.dat"],
+    "coverage_line_merged.info": ["coverage_line.dat", "coverage_line_rerun.dat"],
+}
+
+
+def read_bytes(path):
+    return Path(path).read_bytes()
+
+
+@pytest.mark.parametrize(("expected", "dat_files"), CASES.items())
+def test_native_converter(tmp_path, expected, dat_files):
+    info_path = tmp_path / expected
+    convert_native([DATA_DIR / name for name in dat_files], info_path)
+    assert read_bytes(info_path) == read_bytes(DATA_DIR / expected)
+
+
+@pytest.mark.skipif(
+    shutil.which("verilator_coverage") is None, reason="verilator_coverage is not available"
+)
+@pytest.mark.parametrize(("expected", "dat_files"), CASES.items())
+def test_verilator_parity(tmp_path, expected, dat_files):
+    dat_paths = [DATA_DIR / name for name in dat_files]
+    native_path = tmp_path / "native.info"
+    verilator_path = tmp_path / "verilator.info"
+    convert_native(dat_paths, native_path)
+    convert_verilator(dat_paths, verilator_path)
+
+    assert read_bytes(verilator_path) == read_bytes(DATA_DIR / expected)
+    assert read_bytes(native_path) == read_bytes(verilator_path)
+
+
+@pytest.mark.parametrize(
+    ("dat_file", "expected"),
+    [
+        ("coverage_test_3_branch.dat", "coverage_merged_branch.info"),
+        ("coverage_test_3_toggle.dat", "coverage_merged_toggle.info"),
+        ("coverage_seed_17.dat", "coverage_merged.info"),
+        ("coverage_seed_18.dat", "coverage_merged.info"),
+        ("coverage.dat", "coverage_merged.info"),
+    ],
+)
+def test_merged_info_name(dat_file, expected):
+    assert merged_info_name(dat_file, "merged") == expected
+
+
+@pytest.mark.parametrize(
+    ("linescov", "expected"),
+    [
+        ("12-14,20", [12, 13, 14, 20]),
+        ("0-2", [1, 2]),
+        ("0", []),
+        ("", []),
+    ],
+)
+def test_parse_lines_range(linescov, expected):
+    assert list(parse_lines_range(linescov)) == expected
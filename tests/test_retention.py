@@ -0,0 +1,38 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+import json
+
+from sitespawner.retention import DEPLOYMENTS_STATE_NAME, apply_retention
+
+
+def make_dirs(page_dir, *names):
+    for name in names:
+        (page_dir / "html" / "dev" / name).mkdir(parents=True)
+
+
+def test_unrecorded_dirs_are_not_evicted(tmp_path):
+    make_dirs(tmp_path, "1", "2", "3")
+    assert apply_retention(tmp_path, "dev/4", retain_last=2) == []
+
+    state = json.loads((tmp_path / DEPLOYMENTS_STATE_NAME).read_text())
+    assert sorted(state["deployments"]) == ["dev/1", "dev/2", "dev/3", "dev/4"]
+
+
+def test_retain_last_keeps_newest(tmp_path):
+    make_dirs(tmp_path, "1", "2", "9", "10")
+    apply_retention(tmp_path, "main")
+
+    # Directories recorded at the same time are ordered by their numbers
+    evicted = apply_retention(tmp_path, "dev/11", retain_last=2)
+    assert evicted == ["dev/1", "dev/2", "dev/9"]
+    assert sorted(p.name for p in (tmp_path / "html" / "dev").iterdir()) == ["10"]
+
+
+def test_dry_run_keeps_dirs(tmp_path):
+    make_dirs(tmp_path, "1", "2")
+    apply_retention(tmp_path, "main")
+
+    assert apply_retention(tmp_path, "main", retain_last=1, dry_run=True) == ["dev/1"]
+    assert (tmp_path / "html" / "dev" / "1").is_dir()
@@ -0,0 +1,197 @@
+# Copyright (c) 2024 Antmicro <www.antmicro.com>
+#
+# SPDX-License-Identifier: Apache-2.0
+
+from sitespawner.tracefile import (
+    NOT_TAKEN,
+    FileCoverage,
+    Tracefile,
+    TracefileCache,
+    iter_records,
+    merge_tracefiles,
+)
+
+TRACEFILE = """\
+TN:test
+SF:/src/top.sv
+FN:3,top
+FNDA:2,top
+FNF:1
+FNH:1
+BRDA:5,0,0,4
+BRDA:5,0,1,-
+BRF:2
+BRH:1
+DA:3,2
+DA:5,0
+DA:5,1
+LF:2
+LH:2
+end_of_record
+SF:/src/alu.sv
+DA:1,0
+end_of_record
+"""
+
+
+def write_tracefile(path, content):
+    path.write_text(content)
+    return path
+
+
+def test_iter_records(tmp_path):
+    path = write_tracefile(tmp_path / "test.info", TRACEFILE)
+    records = list(iter_records(path))
+
+    assert [(test_name, record.path) for test_name, record in records] == [
+        ("test", "/src/top.sv"),
+        ("test", "/src/alu.sv"),
+    ]
+    top = records[0][1]
+    # Repeated DA entries are summed, summaries are computed from the data
+    assert top.line_dict() == {3: 2, 5: 1}
+    assert top.branch_dict() == {(5, "0,0"): 4, (5, "0,1"): NOT_TAKEN}
+    assert top.function_dict() == {"top": (3, 2)}
+    assert (top.lines_found, top.lines_hit) == (2, 2)
+    assert (top.branches_found, top.branches_hit) == (2, 1)
+    assert records[1][1].line_dict() == {1: 0}
+
+
+def test_file_coverage_merge():
+    record = FileCoverage(
+        "/src/top.sv",
+        lines={1: 1, 2: 0},
+        branches={(2, "0,0"): 2, (2, "0,1"): NOT_TAKEN, (2, "0,2"): NOT_TAKEN},
+        functions={"top": (1, 1)},
+    )
+    other = FileCoverage(
+        "/src/top.sv",
+        lines={2: 3, 4: 0},
+        branches={(2, "0,0"): 5, (2, "0,1"): 1, (2, "0,2"): NOT_TAKEN},
+        functions={"top": (9, 2), "sub": (4, 0)},
+    )
+    record.merge(other)
+
+    assert record.line_dict() == {1: 1, 2: 3, 4: 0}
+    # Branches which were never evaluated in any input stay '-'
+    assert record.branch_dict() == {(2, "0,0"): 7, (2, "0,1"): 1, (2, "0,2"): NOT_TAKEN}
+    # Functions keep the line of their first occurrence
+    assert record.function_dict() == {"top": (1, 3), "sub": (4, 0)}
+
+
+def test_to_lcov_round_trip(tmp_path):
+    path = write_tracefile(tmp_path / "test.info", TRACEFILE)
+    records = list(iter_records(path))
+
+    written = "".join(record.to_lcov(test_name) for test_name, record in records)
+    reread = list(iter_records(write_tracefile(tmp_path / "written.info", written)))
+
+    for (_, record), (_, copy) in zip(records, reread):
+        assert copy.path == record.path
+        assert copy.line_dict() == record.line_dict()
+        assert copy.branch_dict() == record.branch_dict()
+        assert copy.function_dict() == record.function_dict()
+    assert "".join(record.to_lcov(test_name) for test_name, record in reread) == written
+
+
+def make_tracefile(*paths):
+    return Tracefile("test", {path: FileCoverage(path, lines={1: 1}) for path in paths})
+
+
+def test_filter_wildcards():
+    tracefile = make_tracefile("/src/rtl/top.sv", "/src/rtl/core/alu.sv", "/src/tb/tb.sv")
+
+    # `*` matches across directories, patterns have to match whole paths
+    assert sorted(tracefile.filter(include=["*/rtl/*"]).files) == [
+        "/src/rtl/core/alu.sv",
+        "/src/rtl/top.sv",
+    ]
+    assert not tracefile.filter(include=["rtl/*"]).files
+    assert sorted(tracefile.filter(include=["/src/??/*"]).files) == ["/src/tb/tb.sv"]
+    # Other regex characters are taken literally
+    assert not tracefile.filter(include=["/src/rtl/top.s."]).files
+
+
+def test_filter_substitute_include_exclude():
+    tracefile = make_tracefile("/build/rtl/top.sv", "/build/rtl/core/alu.sv", "/build/tb/tb.sv")
+    filtered = tracefile.filter(
+        include=["/src/rtl/*"],
+        exclude=["*/core/*"],
+        substitute=("/build", "/src"),
+    )
+
+    # Paths are substituted before the include and exclude patterns are applied
+    assert list(filtered.files) == ["/src/rtl/top.sv"]
+    assert filtered.files["/src/rtl/top.sv"].path == "/src/rtl/top.sv"
+    # The original tracefile is left unchanged
+    assert sorted(tracefile.files) == sorted(
+        ["/build/rtl/top.sv", "/build/rtl/core/alu.sv", "/build/tb/tb.sv"]
+    )
+    assert tracefile.files["/build/rtl/top.sv"].path == "/build/rtl/top.sv"
+
+
+def test_to_lcov_without_functions():
+    record = FileCoverage("/src/top.sv", lines={1: 1, 2: 0})
+    assert record.to_lcov("test") == (
+        "TN:test\nSF:/src/top.sv\nDA:1,1\nDA:2,0\nLF:2\nLH:1\nend_of_record\n"
+    )
+
+
+def test_merge_tracefiles_in_batches(tmp_path):
+    inputs = []
+    for i in range(5):
+        # Records are written in reverse order of their paths, so inputs need sorting
+        records = [
+            FileCoverage(
+                f"/src/{name}.sv",
+                lines={1: i, 2 + i: 1},
+                branches={(1, "0,0"): i or NOT_TAKEN, (1, "0,1"): NOT_TAKEN},
+            )
+            for name in ("top", "core", "alu")[: 1 + i % 3]
+        ]
+        path = write_tracefile(
+            tmp_path / f"test_{i}.info", "".join(record.to_lcov("test") for record in records)
+        )
+        inputs.append((path, records))
+
+    spill_dir = tmp_path / "spill"
+    spill_dir.mkdir()
+    output = tmp_path / "merged.info"
+    merge_tracefiles([path for path, _ in inputs], output, fan_in=2, spill_dir=spill_dir)
+
+    expected = {}
+    for _, records in inputs:
+        for record in records:
+            if record.path in expected:
+                expected[record.path].merge(record)
+            else:
+                expected[record.path] = record
+
+    merged = {record.path: record for _, record in iter_records(output)}
+    assert list(merged) == sorted(expected)
+    for path, record in expected.items():
+        assert merged[path].line_dict() == record.line_dict()
+        assert merged[path].branch_dict() == record.branch_dict()
+    # Intermediate files are removed
+    assert not any(spill_dir.iterdir())
+
+
+def test_cache_memo_limit(tmp_path):
+    paths = [
+        write_tracefile(
+            tmp_path / f"test_{i}.info", FileCoverage("/src/top.sv", {1: i, 2: 0}).to_lcov()
+        )
+        for i in range(3)
+    ]
+    cache = TracefileCache(memo_entries=5)
+    for path in paths:
+        cache.load(path)
+
+    # Each tracefile holds two line entries, only the two most recent ones fit
+    assert (len(cache.memo), cache.memo_total) == (2, 4)
+    assert cache.load(paths[2]) is cache.load(paths[2])
+
+    # Tracefiles exceeding the limit on their own aren't kept
+    cache = TracefileCache(memo_entries=1)
+    cache.load(paths[0])
+    assert not cache.memo